@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Admin lookup latency (/addcredit @user, /usercredits @user) on a large
+users table, before and after the schema migrations add the username index.
+
+  python benchmarks/bench_admin_lookup.py [--users 1000000] [--lookups 200]
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+TMP = tempfile.mkdtemp(prefix="groupbot-bench-")
+os.environ["DATABASE"] = os.path.join(TMP, "bench.db")
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "bench")
+os.environ.setdefault("TELETHON_SESSION", "bench")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import group  # noqa: E402
+
+
+def fill(n):
+    """Create the pre-migration users table and n users in it."""
+    conn = sqlite3.connect(group.DATABASE)
+    conn.execute(
+        "CREATE TABLE users (user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT, credits INTEGER, created_at INTEGER)"
+    )
+    now = int(time.time())
+    with conn:
+        conn.executemany(
+            "INSERT INTO users VALUES (?,?,?,?,?)",
+            ((i, f"user{i}", "Bench", 10, now) for i in range(1, n + 1)),
+        )
+    conn.close()
+
+
+def measure(fn, names):
+    samples = []
+    for name in names:
+        started = time.perf_counter()
+        fn(name)
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.95) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--lookups", type=int, default=200)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    fill(args.users)
+    print(f"{args.users} users inserted in {time.perf_counter() - started:.1f}s ({group.DATABASE})")
+    names = [f"User{random.randint(1, args.users)}" for _ in range(args.lookups)]
+
+    conn = group.get_db()
+    before = measure(
+        lambda n: conn.execute("SELECT user_id, credits FROM users WHERE username=? COLLATE NOCASE", (n,)).fetchone(),
+        names,
+    )
+
+    started = time.perf_counter()
+    group.init_db()
+    migrate = time.perf_counter() - started
+    after = measure(group.find_user_by_username, names)
+
+    print(f"migrations: {migrate:.1f}s")
+    print(f"{'':<8}{'p50 ms':>10}{'p95 ms':>10}")
+    print(f"{'before':<8}{before[0]:>10.3f}{before[1]:>10.3f}")
+    print(f"{'after':<8}{after[0]:>10.3f}{after[1]:>10.3f}")
+    print(f"speedup (p50): {before[0] / after[0]:.0f}x")
+    group.close_db()
+
+
+if __name__ == "__main__":
+    main()
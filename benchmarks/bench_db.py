@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for the credits database helpers.
+
+Compares the old connect-per-call pattern with the pooled WAL connections
+used by group.py. Runs against a throwaway database, no Telegram access.
+
+  python benchmarks/bench_db.py [--ops 5000] [--threads 8]
+  python benchmarks/bench_db.py --stress [--threads 32]
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+TMP = tempfile.mkdtemp(prefix="groupbot-bench-")
+os.environ["DATABASE"] = os.path.join(TMP, "bench.db")
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "bench")
+os.environ.setdefault("TELETHON_SESSION", "bench")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import group  # noqa: E402
+
+
+# --- the pre-pool helpers, one connection per call ---
+def naive_get_user(user_id):
+    conn = sqlite3.connect(group.DATABASE)
+    cur = conn.cursor()
+    cur.execute("SELECT user_id, username, first_name, credits, created_at FROM users WHERE user_id=?", (user_id,))
+    row = cur.fetchone()
+    conn.close()
+    return row
+
+
+def naive_add_credits(user_id, amount):
+    conn = sqlite3.connect(group.DATABASE)
+    cur = conn.cursor()
+    cur.execute("UPDATE users SET credits = credits + ? WHERE user_id=?", (amount, user_id))
+    conn.commit()
+    conn.close()
+
+
+def naive_increment_stat(key, amount=1):
+    conn = sqlite3.connect(group.DATABASE)
+    cur = conn.cursor()
+    cur.execute("INSERT OR IGNORE INTO stats(key, value) VALUES (?, ?)", (key, 0))
+    cur.execute("UPDATE stats SET value = value + ? WHERE key=?", (amount, key))
+    conn.commit()
+    conn.close()
+
+
+def naive_try_consume(user_id, cost):
+    row = naive_get_user(user_id)
+    if not row or row[3] < cost:
+        return False
+    naive_add_credits(user_id, -cost)
+    naive_increment_stat("total_searches", 1)
+    return True
+
+
+def pooled_try_consume(user_id, cost):
+    ok, _ = group.try_consume_credits(user_id, cost)
+    return ok
+
+
+SCENARIOS = {
+    "get_user": (naive_get_user, group.get_user),
+    "add_credits": (lambda uid: naive_add_credits(uid, 1), lambda uid: group.add_credits_to_user_id(uid, 1)),
+    "increment_stat": (lambda uid: naive_increment_stat("bench"), lambda uid: group.increment_stat("bench")),
+    "consume+refund": (
+        lambda uid: naive_try_consume(uid, 1) and naive_add_credits(uid, 1),
+        lambda uid: pooled_try_consume(uid, 1) and group.refund_credits(uid, 1),
+    ),
+}
+
+
+def run(fn, ops, threads, users):
+    errors = []
+    per_thread = ops // threads
+
+    def worker(offset):
+        for i in range(per_thread):
+            try:
+                fn(users[(offset + i) % len(users)])
+            except sqlite3.OperationalError as e:
+                errors.append(str(e))
+
+    ts = [threading.Thread(target=worker, args=(n * 7,)) for n in range(threads)]
+    started = time.perf_counter()
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    elapsed = time.perf_counter() - started
+    return per_thread * threads / elapsed, len(errors)
+
+
+def stress(threads, credits=1000, cost=3):
+    """Many threads debit one user at once; the balance must never go negative."""
+    uid = 10**9
+    group.create_user_if_missing(uid, "stress", "Stress")
+    group.get_db().execute("UPDATE users SET credits=? WHERE user_id=?", (credits, uid))
+    group.get_db().commit()
+    successes = []
+    barrier = threading.Barrier(threads)
+
+    def worker():
+        barrier.wait()
+        while True:
+            ok, balance = group.debit_credits(uid, cost, stat_key=None)
+            if not ok:
+                return
+            assert balance >= 0, balance
+            successes.append(balance)
+
+    ts = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    elapsed = time.perf_counter() - started
+    final = group.get_user(uid)["credits"]
+    expected = credits // cost
+    print(f"stress: {threads} threads, {len(successes)} debits in {elapsed:.2f}s, final balance {final}")
+    assert final == credits - expected * cost, final
+    assert len(successes) == expected, len(successes)
+    assert len(set(successes)) == len(successes), "two debits saw the same balance"
+    print("stress: OK (no double spends, balance never negative)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ops", type=int, default=5000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--stress", action="store_true", help="run the concurrent debit check instead")
+    args = parser.parse_args()
+
+    group.init_db()
+    if args.stress:
+        stress(args.threads)
+        return
+
+    users = list(range(1, args.users + 1))
+    for uid in users:
+        group.create_user_if_missing(uid, f"user{uid}", "Bench")
+
+    print(f"sqlite {sqlite3.sqlite_version}, {args.ops} ops, db {group.DATABASE}")
+    print(f"{'scenario':<16}{'threads':>8}{'before ops/s':>15}{'after ops/s':>14}{'speedup':>9}{'locked':>10}")
+    for name, (before, after) in SCENARIOS.items():
+        for threads in (1, args.threads):
+            b_ops, b_err = run(before, args.ops, threads, users)
+            a_ops, a_err = run(after, args.ops, threads, users)
+            print(f"{name:<16}{threads:>8}{b_ops:>15.0f}{a_ops:>14.0f}{a_ops / b_ops:>8.1f}x{f'{b_err}/{a_err}':>10}")
+    group.close_db()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+"""
+Offline load test for the bot, no network and no Telegram account needed.
+
+The Telethon clients and the PTB Bot are swapped for local fakes with a
+configurable latency, FloodWait rate and group size. Synthetic users then
+drive check_handler, inline_query_handler and the DB helpers from a pool of
+worker threads (like PTB's run_async workers), and the run reports
+p50/p95/p99 latency, throughput and DB statements per request.
+
+  python benchmarks/loadtest.py [--scenario check|inline|db|mixed] [--requests 2000]
+      [--concurrency 16] [--users 500] [--groups 200] [--tele-latency 0.05]
+      [--bot-latency 0.02] [--flood-rate 0.01] [--admins 30] [--refresh 0.1]
+  python benchmarks/loadtest.py --json after.json --baseline before.json
+
+Scheduler rates are lifted by default so the fake backend is the bottleneck;
+--real-rates keeps the production RATE_* buckets.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+SCENARIOS = ("check", "inline", "db", "mixed")
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Offline load test with fake Telegram backends")
+    p.add_argument("--scenario", choices=SCENARIOS, default="mixed")
+    p.add_argument("--requests", type=int, default=2000)
+    p.add_argument("--concurrency", type=int, default=16, help="worker threads, like BOT_WORKERS")
+    p.add_argument("--users", type=int, default=500)
+    p.add_argument("--groups", type=int, default=200, help="distinct groups; fewer means more cache hits")
+    p.add_argument("--admins", type=int, default=30, help="admins per group")
+    p.add_argument("--members", type=int, default=50000, help="members per group")
+    p.add_argument("--tele-latency", type=float, default=0.05, help="mean seconds per Telethon call")
+    p.add_argument("--bot-latency", type=float, default=0.02, help="mean seconds per Bot API call")
+    p.add_argument("--flood-rate", type=float, default=0.0, help="share of Telethon calls failing with FloodWait")
+    p.add_argument("--flood-seconds", type=int, default=1)
+    p.add_argument("--refresh", type=float, default=0.0, help="share of /check calls with the refresh argument")
+    p.add_argument("--inline-debounce", type=float, default=0.0)
+    p.add_argument("--real-rates", action="store_true", help="keep the production token bucket rates")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--json", help="write the results to this file")
+    p.add_argument("--baseline", help="compare against results written earlier with --json")
+    return p.parse_args(argv)
+
+
+args = parse_args()
+
+# group.py reads its config at import time
+TMP = tempfile.mkdtemp(prefix="groupbot-load-")
+os.environ["DATABASE"] = os.path.join(TMP, "load.db")
+os.environ.setdefault("BOT_TOKEN", "0:load")
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "load")
+os.environ.setdefault("TELETHON_SESSION", "load")
+os.environ["DEFAULT_CREDITS"] = "1000000000"
+os.environ["INLINE_DEBOUNCE"] = str(args.inline_debounce)
+# synthetic users fire far faster than people do; set USER_RATE to test the limiter
+os.environ.setdefault("USER_RATE", "0")
+if not args.real_rates:
+    for name in ("RATE_RESOLVE", "RATE_CHANNELS", "RATE_FULL_CHANNEL", "RATE_HISTORY", "RATE_PARTICIPANTS"):
+        os.environ[name] = "100000,100000"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import group  # noqa: E402
+from telethon.errors.rpcerrorlist import FloodWaitError  # noqa: E402
+from telethon.tl.types import (  # noqa: E402
+    Channel,
+    ChannelParticipantAdmin,
+    ChannelParticipantCreator,
+    ChatAdminRights,
+    ChatPhotoEmpty,
+)
+
+rng = random.Random(args.seed)
+rng_lock = threading.Lock()
+
+
+def jitter(mean):
+    """Exponential-ish latency around `mean`, never negative."""
+    if mean <= 0:
+        return 0.0
+    with rng_lock:
+        return min(rng.expovariate(1 / mean), mean * 10)
+
+
+def chance(p):
+    with rng_lock:
+        return rng.random() < p
+
+
+# --- fake Telethon client ---
+class FakeIterator:
+    """Async iterator paying one RPC per page of 100, as Telethon's iterators do."""
+
+    def __init__(self, items, total, rpc):
+        self._items = iter(items)
+        self._rpc = rpc
+        self._seen = 0
+        self.total = total
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._seen % 100 == 0:
+            await self._rpc()
+        self._seen += 1
+        try:
+            return next(self._items)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class FakeTelegramClient:
+    """The subset of TelegramClient that fetch_group_info_async uses."""
+
+    def __init__(self, groups):
+        self.groups = groups
+        self.by_name = {g.username.lower(): g for g in groups}
+        self.by_id = {g.id: g for g in groups}
+        self.calls = 0
+
+    def is_connected(self):
+        return True
+
+    async def connect(self):
+        pass
+
+    async def disconnect(self):
+        pass
+
+    async def _rpc(self):
+        self.calls += 1
+        await asyncio.sleep(jitter(args.tele_latency))
+        if args.flood_rate and chance(args.flood_rate):
+            raise FloodWaitError(request=None, capture=args.flood_seconds)
+
+    async def get_entity(self, peer):
+        await self._rpc()
+        if isinstance(peer, str):
+            entity = self.by_name.get(peer.lstrip("@").lower())
+        else:
+            entity = self.by_id.get(getattr(peer, "channel_id", None) or getattr(peer, "chat_id", None) or peer)
+        if entity is None:
+            raise ValueError(f'No user has "{peer}" as username')
+        return entity
+
+    async def __call__(self, request):
+        await self._rpc()
+        return SimpleNamespace(full_chat=SimpleNamespace(participants_count=request.channel.participants_count))
+
+    def iter_messages(self, entity, reverse=False, limit=None):
+        async def gen():
+            await self._rpc()
+            yield SimpleNamespace(id=1, date=entity.date)
+
+        return gen()
+
+    def iter_participants(self, entity, filter=None, limit=None):
+        admins = fake_admins(entity.id, args.admins)
+        return FakeIterator(admins[:limit], total=len(admins), rpc=self._rpc)
+
+
+def make_groups(n):
+    base = datetime(2016, 1, 1, tzinfo=timezone.utc)
+    groups = []
+    for i in range(n):
+        groups.append(
+            Channel(
+                id=1000000000 + i * 7919,
+                title=f"Load test group {i}",
+                photo=ChatPhotoEmpty(),
+                date=base + timedelta(days=i),
+                megagroup=True,
+                access_hash=i * 31 + 1,
+                username=f"loadgroup{i}",
+                participants_count=args.members,
+            )
+        )
+    return groups
+
+
+def fake_admins(group_id, count):
+    out = []
+    for i in range(count):
+        if i == 0:
+            participant = ChannelParticipantCreator(user_id=group_id + i, admin_rights=ChatAdminRights())
+        else:
+            participant = ChannelParticipantAdmin(
+                user_id=group_id + i, promoted_by=group_id, date=datetime.now(timezone.utc), admin_rights=ChatAdminRights()
+            )
+        out.append(SimpleNamespace(id=group_id + i, first_name=f"Admin{i}", last_name=None, username=None, participant=participant))
+    return out
+
+
+# --- fake PTB objects ---
+class FakeBot:
+    def __init__(self):
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _api(self):
+        with self._lock:
+            self.calls += 1
+        time.sleep(jitter(args.bot_latency))
+
+    def get_chat_member(self, chat_id, user_id):
+        self._api()
+        return SimpleNamespace(status="member")
+
+
+class FakeMessage:
+    def __init__(self, bot):
+        self.bot = bot
+        self.replies = []
+
+    def reply_text(self, text, **kwargs):
+        self.bot._api()
+        self.replies.append(text)
+
+
+class FakeInlineQuery:
+    def __init__(self, bot, user, query):
+        self.bot = bot
+        self.from_user = user
+        self.query = query
+        self.answers = []
+        self.answered = threading.Event()
+
+    def answer(self, results, **kwargs):
+        self.bot._api()
+        self.answers.append(results)
+        self.answered.set()
+
+
+class FakeDispatcher:
+    """PTB's Dispatcher.run_async, on a pool shaped like BOT_WORKERS."""
+
+    def __init__(self, workers):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def run_async(self, func, *args, update=None, **kwargs):
+        return self.pool.submit(func, *args, **kwargs)
+
+
+def fake_user(user_id):
+    return SimpleNamespace(id=user_id, username=f"loaduser{user_id}", first_name="Load")
+
+
+# --- DB statement counter ---
+class StatementCounter:
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.total = 0
+
+    def install(self):
+        get_db = group.get_db
+
+        def counting_get_db():
+            conn = get_db()
+            if getattr(self._local, "conn", None) is not conn:
+                conn.set_trace_callback(self._count)
+                self._local.conn = conn
+            return conn
+
+        group.get_db = counting_get_db
+
+    def _count(self, statement):
+        with self._lock:
+            self.total += 1
+
+
+# --- workload ---
+def pick_group(groups):
+    # skewed popularity, like real traffic: a few groups get most lookups
+    with rng_lock:
+        i = min(int(rng.paretovariate(1.2)) - 1, len(groups) - 1)
+        return groups[i]
+
+
+def pick_user():
+    with rng_lock:
+        return 100000 + rng.randrange(args.users)
+
+
+def do_check(bot, groups):
+    user = fake_user(pick_user())
+    target = "@" + pick_group(groups).username
+    argv = [target, "refresh"] if args.refresh and chance(args.refresh) else [target]
+    message = FakeMessage(bot)
+    update = SimpleNamespace(effective_user=user, message=message)
+    group.check_handler(update, SimpleNamespace(args=argv, bot=bot))
+    # errors and shed requests ("busy, try again") count as failures
+    return not message.replies[-1].startswith(("⚠️", "⏳"))
+
+
+def do_inline(bot, groups):
+    user = fake_user(pick_user())
+    query = FakeInlineQuery(bot, user, "@" + pick_group(groups).username)
+    group.inline_query_handler(SimpleNamespace(inline_query=query), SimpleNamespace(bot=bot, dispatcher=dispatcher))
+    # cached groups are answered in the handler, others from a worker after the debounce
+    query.answered.wait(group.INLINE_DEBOUNCE + group.INLINE_ANSWER_TIMEOUT + 1)
+    return bool(query.answers) and query.answers[-1][0].id.startswith("info:")
+
+
+dispatcher = FakeDispatcher(int(os.getenv("BOT_WORKERS", "32")))
+
+
+def do_db(bot, groups):
+    user = fake_user(pick_user())
+    group.create_user_if_missing(user.id, user.username, user.first_name)
+    ok, _ = group.try_consume_credits(user.id, group.COST_PER_SEARCH)
+    group.increment_stat("check_searches")
+    group.get_user(user.id)
+    return ok
+
+
+WORKLOADS = {"check": do_check, "inline": do_inline, "db": do_db}
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    i = min(len(sorted_values) - 1, int(round(q / 100 * (len(sorted_values) - 1))))
+    return sorted_values[i]
+
+
+def run(scenario, groups, bot, counter):
+    kinds = ["check", "inline", "db"] if scenario == "mixed" else [scenario]
+    plan = [kinds[i % len(kinds)] for i in range(args.requests)]
+    latencies = {kind: [] for kind in kinds}
+    failures = {kind: 0 for kind in kinds}
+    lock = threading.Lock()
+
+    def one(kind):
+        started = time.perf_counter()
+        try:
+            ok = WORKLOADS[kind](bot, groups)
+        except Exception:
+            ok = False
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies[kind].append(elapsed)
+            if not ok:
+                failures[kind] += 1
+
+    db_before = counter.total
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(one, plan))
+    wall = time.perf_counter() - started
+    group.flush_stats()
+
+    results = {"scenario": scenario, "requests": args.requests, "concurrency": args.concurrency, "wall_s": wall}
+    results["throughput_rps"] = args.requests / wall if wall else 0.0
+    results["db_statements_per_request"] = (counter.total - db_before) / args.requests
+    results["kinds"] = {}
+    for kind in kinds:
+        values = sorted(latencies[kind])
+        results["kinds"][kind] = {
+            "count": len(values),
+            "failures": failures[kind],
+            "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+        }
+    results["telethon_calls"] = sum(s.client.calls for s in group.tele_sessions)
+    results["bot_api_calls"] = bot.calls
+    results["cache"] = group.group_cache.stats()
+    results["coalesce"] = dict(group.coalesce_counters)
+    return results
+
+
+def report(results, baseline=None):
+    def delta(path, value):
+        if baseline is None:
+            return ""
+        old = baseline
+        for part in path:
+            old = old.get(part) if isinstance(old, dict) else None
+        if not old:
+            return ""
+        return f"  ({(value - old) / old * 100:+.1f}%)"
+
+    r = results
+    print(f"scenario={r['scenario']} requests={r['requests']} concurrency={r['concurrency']} wall={r['wall_s']:.2f}s")
+    print(f"throughput: {r['throughput_rps']:.1f} req/s{delta(('throughput_rps',), r['throughput_rps'])}")
+    print(
+        f"db statements/request: {r['db_statements_per_request']:.2f}"
+        f"{delta(('db_statements_per_request',), r['db_statements_per_request'])}"
+    )
+    print(f"telethon calls: {r['telethon_calls']}  bot api calls: {r['bot_api_calls']}")
+    c = r["cache"]
+    print(f"cache: {c['hits']} hits / {c['stale_hits']} stale / {c['misses']} misses, coalesced {r['coalesce']['coalesced']}")
+    print(f"{'kind':<8}{'count':>7}{'fail':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for kind, k in r["kinds"].items():
+        print(f"{kind:<8}{k['count']:>7}{k['failures']:>6}{k['p50_ms']:>10.1f}{k['p95_ms']:>10.1f}{k['p99_ms']:>10.1f}")
+        if baseline is not None:
+            cols = "".join(f"{delta(('kinds', kind, col), k[col]):>10}" for col in ("p50_ms", "p95_ms", "p99_ms"))
+            print(f"{'':<21}{cols}")
+
+
+def main():
+    group.init_db()
+    counter = StatementCounter()
+    counter.install()
+    groups = make_groups(args.groups)
+    for sess in group.tele_sessions:
+        sess.client = FakeTelegramClient(groups)
+    group.tele_client = group.tele_sessions[0].client
+    group.start_tele_loop()
+
+    results = run(args.scenario, groups, FakeBot(), counter)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    group.stop_persist_writer()
+    group.close_db()
+
+
+if __name__ == "__main__":
+    main()
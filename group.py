@@ -7,10 +7,20 @@ Environment variables required:
   API_ID               - my.telegram.org API ID (int)
   API_HASH             - my.telegram.org API HASH (string)
   TELETHON_SESSION     - Telethon StringSession (string)
+  TELETHON_SESSIONS    - optional extra StringSessions, comma separated
   CHANNEL_USERNAME     - channel to require join (default @Royalofficial143)
   ADMIN_USERNAME       - admin username without @ (default rocky_2ooo)
   COST_PER_SEARCH      - integer (default 5)
   DEFAULT_CREDITS      - integer (default 10)
+  BOT_MODE             - polling (default) or webhook
+  WEBHOOK_URL          - public base URL for webhook mode (default RENDER_EXTERNAL_URL)
+  PORT                 - HTTP port for the webhook, /healthz and /metrics
+
+Bulk lookups without the bot (no credits involved, BOT_TOKEN not needed):
+  python group.py bulkcheck groups.txt -o results.csv [--format json]
+
+Inline results are charged when the user sends them, which needs inline
+feedback turned on for the bot (@BotFather -> /setinlinefeedback).
 
 Requirements (requirements.txt):
   python-telegram-bot==13.15
@@ -18,18 +28,38 @@ Requirements (requirements.txt):
 """
 
 import os
+import io
+import re
+import sys
+import json
+import argparse
+import contextlib
+import functools
+import inspect
+import signal
+import tempfile
+import zlib
+import bisect
+import heapq
+import hashlib
+import asyncio
+import concurrent.futures
+import contextvars
 import logging
 import sqlite3
+import threading
 import time
 import csv
+import queue
+import gzip
+from collections import OrderedDict, deque, namedtuple
 from html import escape
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-from telethon import TelegramClient
-from telethon.sessions import StringSession
-from telethon.tl.types import ChannelParticipantsAdmins, Channel
-from telethon.errors.rpcerrorlist import RPCError
+_process_started = time.perf_counter()
 
+# telethon is imported on the Telethon loop thread (see _import_telethon)
 
 from telegram import (
     InlineKeyboardButton,
@@ -44,7 +74,9 @@ from telegram.ext import (
     CommandHandler,
     InlineQueryHandler,
     CallbackQueryHandler,
+    ChosenInlineResultHandler,
     MessageHandler,
+    ChatMemberHandler,
     Filters,
     CallbackContext,
 )
@@ -54,6 +86,8 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 API_ID = int(os.getenv("API_ID") or "0")
 API_HASH = os.getenv("API_HASH") or ""
 TELETHON_SESSION = os.getenv("TELETHON_SESSION") or ""
+# optional extra sessions (comma/whitespace separated) to spread lookups over
+TELETHON_SESSIONS = os.getenv("TELETHON_SESSIONS") or ""
 CHANNEL_USERNAME = os.getenv("CHANNEL_USERNAME", "@Royalofficial143")
 ADMIN_USERNAME = os.getenv("ADMIN_USERNAME", "rocky_2ooo").lstrip("@")
 DATABASE = os.getenv("DATABASE", "groupbot.db")
@@ -62,9 +96,101 @@ DEFAULT_CREDITS = int(os.getenv("DEFAULT_CREDITS", "10"))
 COST_PER_SEARCH = int(os.getenv("COST_PER_SEARCH", "5"))
 REFERRAL_REWARD = int(os.getenv("REFERRAL_REWARD", "10"))
 
-# sanity checks
-if not BOT_TOKEN:
-    raise RuntimeError("BOT_TOKEN env var is required")
+# update delivery: "polling" or "webhook". Webhook mode serves updates on PORT
+# at WEBHOOK_URL (Render provides RENDER_EXTERNAL_URL and PORT).
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") or os.getenv("RENDER_EXTERNAL_URL") or ""
+PORT = int(os.getenv("PORT") or "0")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "25"))
+
+# concurrency
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "32"))
+TELE_TIMEOUT = float(os.getenv("TELE_TIMEOUT", "60"))
+TELE_CONNECT_MAX_BACKOFF = float(os.getenv("TELE_CONNECT_MAX_BACKOFF", "60"))
+STEP_TIMEOUT_FULL = float(os.getenv("STEP_TIMEOUT_FULL", "10"))
+STEP_TIMEOUT_HISTORY = float(os.getenv("STEP_TIMEOUT_HISTORY", "10"))
+STEP_TIMEOUT_ADMINS = float(os.getenv("STEP_TIMEOUT_ADMINS", "15"))
+
+# FloodWait handling: sleep through waits up to FLOOD_MAX_SLEEP seconds,
+# retrying at most FLOOD_RETRIES times. Rates are "calls_per_sec,burst"
+# (RATE_RESOLVE, RATE_FULL_CHANNEL, RATE_HISTORY, RATE_PARTICIPANTS).
+FLOOD_MAX_SLEEP = int(os.getenv("FLOOD_MAX_SLEEP", "30"))
+FLOOD_RETRIES = int(os.getenv("FLOOD_RETRIES", "2"))
+# how many more in-flight lookups the hashed session may have than the idlest one
+SESSION_MAX_SKEW = int(os.getenv("SESSION_MAX_SKEW", "4"))
+
+# admins: names shown per lookup, and the most participants scanned looking for the creator
+ADMIN_LIST_CAP = int(os.getenv("ADMIN_LIST_CAP", "10"))
+ADMIN_SCAN_LIMIT = int(os.getenv("ADMIN_SCAN_LIMIT", "200"))
+
+# creation date estimator: widest gap (seconds) between calibration points
+# that still counts as a confident estimate
+ESTIMATE_MAX_SPAN = int(os.getenv("ESTIMATE_MAX_SPAN", str(30 * 86400)))
+
+# entity store: re-resolve usernames after this many seconds; rows loaded at startup
+ENTITY_REFRESH_AGE = int(os.getenv("ENTITY_REFRESH_AGE", "604800"))
+ENTITY_PREWARM_LIMIT = int(os.getenv("ENTITY_PREWARM_LIMIT", "50000"))
+
+# group result store: stored results older than this aren't served; max queued writes
+GROUP_STORE_MAX_AGE = int(os.getenv("GROUP_STORE_MAX_AGE", str(7 * 86400)))
+PERSIST_QUEUE_MAX = int(os.getenv("PERSIST_QUEUE_MAX", "10000"))
+
+# bulk lookups
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "8"))
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", "500"))
+BULK_MAX_FILE_BYTES = int(os.getenv("BULK_MAX_FILE_BYTES", str(512 * 1024)))
+BULK_PROGRESS_INTERVAL = float(os.getenv("BULK_PROGRESS_INTERVAL", "3"))
+BULK_BUSY_RETRIES = int(os.getenv("BULK_BUSY_RETRIES", "4"))
+
+# sqlite tuning
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "256"))
+STATS_FLUSH_INTERVAL = int(os.getenv("STATS_FLUSH_INTERVAL", "30"))
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "1000"))
+
+# channel membership cache
+MEMBERSHIP_TTL = int(os.getenv("MEMBERSHIP_TTL", "600"))
+MEMBERSHIP_NEGATIVE_TTL = int(os.getenv("MEMBERSHIP_NEGATIVE_TTL", "15"))
+MEMBERSHIP_MAX_ENTRIES = int(os.getenv("MEMBERSHIP_MAX_ENTRIES", "100000"))
+# set to 1 when the bot is admin in CHANNEL_USERNAME to receive chat_member updates
+MEMBERSHIP_UPDATES = os.getenv("MEMBERSHIP_UPDATES", "0") == "1"
+
+# inline mode (seconds)
+INLINE_DEBOUNCE = float(os.getenv("INLINE_DEBOUNCE", "0.7"))
+INLINE_ANSWER_TIMEOUT = float(os.getenv("INLINE_ANSWER_TIMEOUT", "8"))
+
+# admission control: a per-user request budget (tokens/s, burst), and a cap on
+# concurrent Telegram fetches with a bounded queue (entries, max wait in s)
+USER_RATE = float(os.getenv("USER_RATE", "0.2"))
+USER_BURST = float(os.getenv("USER_BURST", "5"))
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", "16"))
+FETCH_QUEUE_MAX = int(os.getenv("FETCH_QUEUE_MAX", "64"))
+FETCH_QUEUE_WAIT = float(os.getenv("FETCH_QUEUE_WAIT", "10"))
+
+# hot group refresher: every HOT_REFRESH_INTERVAL s, refresh up to
+# HOT_REFRESH_BUDGET of the HOT_TOP_N most looked-up groups before they go stale
+HOT_TOP_N = int(os.getenv("HOT_TOP_N", "50"))
+HOT_REFRESH_INTERVAL = int(os.getenv("HOT_REFRESH_INTERVAL", "60"))
+HOT_REFRESH_BUDGET = int(os.getenv("HOT_REFRESH_BUDGET", "10"))
+HOT_HALF_LIFE = int(os.getenv("HOT_HALF_LIFE", "3600"))
+HOT_MAX_TRACKED = int(os.getenv("HOT_MAX_TRACKED", "10000"))
+
+# warm restart: caches are written here at graceful shutdown and read back on
+# start if younger than SNAPSHOT_MAX_AGE seconds ("" disables)
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", DATABASE + ".snapshot.json.gz")
+SNAPSHOT_MAX_AGE = int(os.getenv("SNAPSHOT_MAX_AGE", str(86400)))
+
+# group info cache (seconds / entries)
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "5000"))
+CACHE_TTL_MEMBERS = int(os.getenv("CACHE_TTL_MEMBERS", "300"))
+CACHE_TTL_ADMINS = int(os.getenv("CACHE_TTL_ADMINS", "3600"))
+CACHE_TTL_META = int(os.getenv("CACHE_TTL_META", "86400"))
+CACHE_STALE_MAX = int(os.getenv("CACHE_STALE_MAX", "604800"))
+CACHE_NEGATIVE_TTL = int(os.getenv("CACHE_NEGATIVE_TTL", "60"))
+
+# sanity checks (BOT_TOKEN is checked in main(); the bulkcheck CLI runs without it)
 if not API_ID or not API_HASH:
     raise RuntimeError("API_ID and API_HASH env vars are required")
 if not TELETHON_SESSION:
@@ -74,199 +200,1362 @@ if not TELETHON_SESSION:
 logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# ---------------- Telethon client ----------------
-tele_client = TelegramClient(StringSession(TELETHON_SESSION), API_ID, API_HASH)
+# ---------------- Metrics ----------------
+# A small in-process registry exported in Prometheus text format on /metrics
+# and summarized in /stats. Recording is a dict update under one lock, cheap
+# enough for every handler, fetch stage and DB helper call.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.help = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def gauge_add(self, name, amount, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.gauges[key] = self.gauges.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        i = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0]
+            h[0][i] += 1
+            h[1] += seconds
+            h[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def counter_values(self, name):
+        """{labels: value} for one counter."""
+        with self._lock:
+            return {k[1]: v for k, v in self.counters.items() if k[0] == name}
+
+    def summary(self, name):
+        """{label_dict_tuple: (count, avg, p95)} for one histogram, p95 from bucket bounds."""
+        with self._lock:
+            items = [(k[1], list(v[0]), v[1], v[2]) for k, v in self.histograms.items() if k[0] == name]
+        out = {}
+        for labels, buckets, total, count in items:
+            if not count:
+                continue
+            target, seen, p95 = count * 0.95, 0, LATENCY_BUCKETS[-1]
+            for bound, n in zip(LATENCY_BUCKETS + (float("inf"),), buckets):
+                seen += n
+                if seen >= target:
+                    p95 = bound
+                    break
+            out[labels] = (count, total / count, p95)
+        return out
+
+    def render(self, extra=()):
+        def fmt(labels):
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+        with self._lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self.histograms.items())
+        lines = []
+        typed = set()
+        for kind, items in (("counter", counters), ("gauge", list(gauges) + list(extra))):
+            for (name, labels), value in items:
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name}{fmt(labels)} {value}")
+        for (name, labels), (buckets, total, count) in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, n in zip(LATENCY_BUCKETS + ("+Inf",), buckets):
+                cumulative += n
+                lines.append(f"{name}_bucket{fmt(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{fmt(labels)} {total}")
+            lines.append(f"{name}_count{fmt(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+def db_timed(fn):
+    """Record latency and errors of a DB helper as groupbot_db_seconds{op=...}."""
+    if inspect.isgeneratorfunction(fn):
+        return _db_timed_generator(fn)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except sqlite3.Error:
+            metrics.inc("groupbot_db_errors_total", op=fn.__name__)
+            raise
+        finally:
+            metrics.observe("groupbot_db_seconds", time.perf_counter() - started, op=fn.__name__)
 
-# ---------------- Database helpers ----------------
-def init_db():
-    conn = sqlite3.connect(DATABASE)
-    cur = conn.cursor()
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            first_name TEXT,
-            credits INTEGER,
-            created_at INTEGER
-        )
-        """
+    return wrapper
+
+
+def _db_timed_generator(fn):
+    """db_timed for generators: the time spent producing rows, not the caller's in between."""
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        gen = fn(*args, **kwargs)
+        spent = 0.0
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    item = next(gen)
+                except StopIteration:
+                    return
+                except sqlite3.Error:
+                    metrics.inc("groupbot_db_errors_total", op=fn.__name__)
+                    raise
+                finally:
+                    spent += time.perf_counter() - started
+                yield item
+        finally:
+            gen.close()
+            metrics.observe("groupbot_db_seconds", spent, op=fn.__name__)
+
+    return wrapper
+
+
+# ---------------- Telethon client ----------------
+# The clients are owned by a single long-lived event loop running in its own
+# thread. Bot handlers (PTB worker threads) submit coroutines to it with
+# run_tele(), so many lookups can be in flight at once. The clients
+# themselves (one per session) live in the session pool below.
+#
+# Importing telethon takes a good part of a second, so it happens on the loop
+# thread before it starts serving coroutines, off the bot's startup path.
+# Everything using the names below runs on that loop.
+TelegramClient = StringSession = GetFullChannelRequest = CheckChatInviteRequest = None
+ChannelParticipantsAdmins = ChannelParticipantCreator = ChatParticipantCreator = None
+Channel = Chat = ChatInvite = ChatInviteAlready = ChatInvitePeek = InputPeerChannel = InputPeerChat = None
+FloodWaitError = RPCError = None
+GROUP_NOT_FOUND_ERRORS = ()
+
+
+def _import_telethon():
+    global TelegramClient, StringSession, GetFullChannelRequest, CheckChatInviteRequest
+    global ChannelParticipantsAdmins, ChannelParticipantCreator, ChatParticipantCreator
+    global Channel, Chat, ChatInvite, ChatInviteAlready, ChatInvitePeek, InputPeerChannel, InputPeerChat
+    global FloodWaitError, RPCError, GROUP_NOT_FOUND_ERRORS
+    from telethon import TelegramClient
+    from telethon.sessions import StringSession
+    from telethon.tl.functions.channels import GetFullChannelRequest
+    from telethon.tl.functions.messages import CheckChatInviteRequest
+    from telethon.tl.types import (
+        ChannelParticipantsAdmins,
+        ChannelParticipantCreator,
+        ChatParticipantCreator,
+        Channel,
+        Chat,
+        ChatInvite,
+        ChatInviteAlready,
+        ChatInvitePeek,
+        InputPeerChannel,
+        InputPeerChat,
     )
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS stats (
-            key TEXT PRIMARY KEY,
-            value INTEGER
-        )
-        """
+    from telethon.errors.rpcerrorlist import (
+        ChannelInvalidError,
+        ChannelPrivateError,
+        FloodWaitError,
+        InviteHashEmptyError,
+        InviteHashExpiredError,
+        InviteHashInvalidError,
+        RPCError,
+        UsernameInvalidError,
+        UsernameNotOccupiedError,
     )
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS pending_credits (
-            username TEXT PRIMARY KEY,
-            credits INTEGER DEFAULT 0
-        )
-        """
+
+    # answers meaning the group isn't there (get_entity raises ValueError for
+    # an unknown username or id); anything else may succeed on a retry
+    GROUP_NOT_FOUND_ERRORS = (
+        ValueError,
+        UsernameNotOccupiedError,
+        UsernameInvalidError,
+        ChannelInvalidError,
+        ChannelPrivateError,
+        InviteHashEmptyError,
+        InviteHashExpiredError,
+        InviteHashInvalidError,
     )
-    cur.execute("INSERT OR IGNORE INTO stats(key, value) VALUES ('total_searches', 0)")
-    conn.commit()
-    conn.close()
 
 
+tele_loop = asyncio.new_event_loop()
+_tele_thread = None
+_tele_thread_lock = threading.Lock()
+tele_connected = threading.Event()
+# set when the loop thread could not import Telethon or create the clients
+# (e.g. a malformed TELETHON_SESSION); lookups then fail at once
+tele_startup_error = None
+
+
+class TeleUnavailable(Exception):
+    """Raised for Telegram lookups when the Telethon client failed to start."""
+
+    def __init__(self):
+        super().__init__("Telegram lookups are unavailable right now, please try again later")
+
+
+def start_tele_loop():
+    global _tele_thread
+    with _tele_thread_lock:
+        if _tele_thread is not None:
+            return
+
+        def run():
+            global tele_startup_error
+            asyncio.set_event_loop(tele_loop)
+            started = time.perf_counter()
+            try:
+                _import_telethon()
+                _create_clients()
+            except Exception as e:
+                tele_startup_error = e
+                logger.exception("Telethon failed to start, Telegram lookups are disabled")
+            else:
+                logger.info("Telethon loaded in %.0fms", (time.perf_counter() - started) * 1000)
+            # keep running either way: queued submissions must not wait out TELE_TIMEOUT
+            tele_loop.run_forever()
+
+        _tele_thread = threading.Thread(target=run, name="telethon-loop", daemon=True)
+        _tele_thread.start()
+
+
+async def _unless_tele_failed(coro):
+    if tele_startup_error is not None:
+        coro.close()
+        raise TeleUnavailable()
+    return await coro
+
+
+def submit_tele(coro):
+    """Schedule a coroutine on the Telethon loop and return a concurrent Future."""
+    start_tele_loop()
+    return asyncio.run_coroutine_threadsafe(_unless_tele_failed(coro), tele_loop)
+
+
+def run_tele(coro, timeout=None):
+    """Run a coroutine on the Telethon loop and block until it finishes."""
+    fut = submit_tele(coro)
+    try:
+        return fut.result(timeout if timeout is not None else TELE_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+        fut.cancel()
+        raise Exception("Telegram request timed out")
+
+
+async def connect_with_backoff(max_delay=None):
+    """Connect every session client, retrying the failed ones with exponential backoff.
+
+    Runs in the background at startup; a lookup arriving first simply
+    connects its session on demand.
+    """
+    max_delay = max_delay or TELE_CONNECT_MAX_BACKOFF
+    started = time.perf_counter()
+    delay = min(1.0, max_delay)
+    attempt = 0
+    while True:
+        attempt += 1
+        pending = [sess for sess in tele_sessions if not sess.client.is_connected()]
+        results = await asyncio.gather(*(sess.ensure_connected() for sess in pending), return_exceptions=True)
+        failed = [(sess, r) for sess, r in zip(pending, results) if isinstance(r, Exception)]
+        if len(failed) < len(tele_sessions):
+            tele_connected.set()
+        if not failed:
+            logger.info("Telethon connected in %.2fs (%s sessions)", time.perf_counter() - started, len(tele_sessions))
+            return
+        for sess, error in failed:
+            logger.warning("Telethon session %s connect failed (attempt %s), retrying in %.0fs: %s", sess.index, attempt, delay, error)
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+
+async def _disconnect_all():
+    await asyncio.gather(*(sess.client.disconnect() for sess in tele_sessions), return_exceptions=True)
+
+
+def stop_tele_loop():
+    if _tele_thread is None:
+        return
+    try:
+        if tele_startup_error is None:
+            run_tele(_disconnect_all(), timeout=10)
+    except Exception as e:
+        logger.warning("Telethon disconnect warning: %s", e)
+    tele_loop.call_soon_threadsafe(tele_loop.stop)
+    _tele_thread.join(timeout=10)
+
+
+# ---------------- Request scheduler ----------------
+# Every MTProto call goes through tele_call(): a token bucket per method class
+# keeps us under Telegram's limits (ResolveUsername is by far the strictest),
+# FloodWaitError pauses the whole class instead of hammering on, and waiting
+# callers are served by priority (/check before inline before background).
+# A fetch shared by several requests runs at the priority of the most urgent
+# one, which can rise while it waits: a /check joining a background refresh
+# must not queue behind inline previews.
+PRIORITY_CHECK = 0
+PRIORITY_INLINE = 1
+PRIORITY_BACKGROUND = 2
+
+request_priority = contextvars.ContextVar("request_priority", default=PRIORITY_CHECK)
+
+
+class FetchPriority:
+    """Priority of one fetch; join() raises it for each request that waits on it."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def join(self, priority):
+        self.value = min(self.value, priority)
+
+
+# set inside a shared fetch (see _fetch_and_store), read by tele_call
+fetch_priority = contextvars.ContextVar("fetch_priority", default=None)
+
+
+class FloodWait(Exception):
+    """Raised when Telegram asks us to wait longer than FLOOD_MAX_SLEEP."""
+
+    def __init__(self, seconds):
+        super().__init__(f"Telegram is rate limiting lookups, try again in {seconds}s")
+        self.seconds = seconds
+
+
+def _rate_setting(name, default):
+    rate, burst = os.getenv(name, default).split(",")
+    return float(rate), float(burst)
+
+
+class TokenBucket:
+    def __init__(self, name, rate, burst):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.waiting = []  # FetchPriority of each waiting caller
+        self.counters = {"calls": 0, "waited": 0, "wait_total": 0.0, "wait_max": 0.0, "flood_waits": 0}
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, fetch):
+        started = time.monotonic()
+        self.waiting.append(fetch)
+        try:
+            while True:
+                now = time.monotonic()
+                if self.blocked_until - now > FLOOD_MAX_SLEEP:
+                    # a long FloodWait: fail now rather than hold the caller for it
+                    raise FloodWait(int(self.blocked_until - now) + 1)
+                self._refill(now)
+                # read on every pass: a waiter's priority rises when a request joins its fetch
+                ahead = any(other.value < fetch.value for other in self.waiting)
+                if now >= self.blocked_until and self.tokens >= 1 and not ahead:
+                    self.tokens -= 1
+                    break
+                if now < self.blocked_until:
+                    delay = self.blocked_until - now
+                elif self.tokens < 1:
+                    delay = (1 - self.tokens) / self.rate
+                else:
+                    delay = 0.01  # let the higher-priority waiter go first
+                await asyncio.sleep(max(delay, 0.005))
+        finally:
+            self.waiting.remove(fetch)
+        waited = time.monotonic() - started
+        self.counters["calls"] += 1
+        if waited > 0.001:
+            self.counters["waited"] += 1
+            self.counters["wait_total"] += waited
+            self.counters["wait_max"] = max(self.counters["wait_max"], waited)
+
+    def flood(self, seconds):
+        self.counters["flood_waits"] += 1
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    def stats(self):
+        out = dict(self.counters)
+        out["queued"] = len(self.waiting)
+        out["blocked_for"] = max(0.0, self.blocked_until - time.monotonic())
+        return out
+
+
+BUCKET_RATES = {
+    "resolve": _rate_setting("RATE_RESOLVE", "0.5,5"),
+    "channels": _rate_setting("RATE_CHANNELS", "5,20"),
+    "full_channel": _rate_setting("RATE_FULL_CHANNEL", "5,20"),
+    "history": _rate_setting("RATE_HISTORY", "5,20"),
+    "participants": _rate_setting("RATE_PARTICIPANTS", "3,10"),
+}
+
+
+# ---------------- Session pool ----------------
+# Each StringSession (TELETHON_SESSION plus TELETHON_SESSIONS) gets its own
+# client and its own buckets, since Telegram's limits are per account. A
+# lookup is routed to one session for all of its steps (access hashes are
+# per account too): rendezvous hashing on the group key keeps each session's
+# entity cache warm, falling back to the least-loaded session when the
+# preferred one is busy. Sessions that hit a long FloodWait are benched.
+class TeleSession:
+    def __init__(self, index, session_string):
+        self.index = index
+        self.session_string = session_string
+        # stable across restarts and reordering, unlike the index
+        self.key = hashlib.sha1(session_string.encode()).hexdigest()[:16]
+        self.client = None  # created on the Telethon loop, see _create_clients
+        self.buckets = {name: TokenBucket(name, rate, burst) for name, (rate, burst) in BUCKET_RATES.items()}
+        self.load = 0
+        self.benched_until = 0.0
+        self.counters = {"fetches": 0, "errors": 0, "benched": 0}
+        self._connect_lock = None
+
+    async def ensure_connected(self):
+        if self.client.is_connected():
+            return
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if not self.client.is_connected():
+                await self.client.connect()
+
+    def connected(self):
+        """Safe from any thread, also before the client exists (telethon still loading)."""
+        return self.client is not None and self.client.is_connected()
+
+    def healthy(self, now=None):
+        return (now or time.monotonic()) >= self.benched_until
+
+    def bench(self, seconds):
+        self.benched_until = max(self.benched_until, time.monotonic() + seconds)
+        self.counters["benched"] += 1
+        logger.warning("Telethon session %s benched for %ss", self.index, seconds)
+
+    def stats(self):
+        return {
+            "load": self.load,
+            "fetches": self.counters["fetches"],
+            "errors": self.counters["errors"],
+            "benched": self.counters["benched"],
+            "benched_for": max(0.0, self.benched_until - time.monotonic()),
+            "flood_waits": sum(b.counters["flood_waits"] for b in self.buckets.values()),
+        }
+
+
+def _session_strings():
+    extra = [s for s in re.split(r"[\s,]+", TELETHON_SESSIONS) if s]
+    return [TELETHON_SESSION] + [s for s in extra if s != TELETHON_SESSION]
+
+
+tele_sessions = [TeleSession(i, s) for i, s in enumerate(_session_strings())]
+tele_client = None
+
+
+def _create_clients():
+    global tele_client
+    for sess in tele_sessions:
+        if sess.client is None:
+            # flood_sleep_threshold=0: FloodWaits are handled by the scheduler
+            sess.client = TelegramClient(StringSession(sess.session_string), API_ID, API_HASH, flood_sleep_threshold=0)
+    tele_client = tele_sessions[0].client
+
+
+def benched_error():
+    """FloodWait until the first benched session is back."""
+    back = min(sess.benched_until for sess in tele_sessions)
+    return FloodWait(max(1, int(back - time.monotonic()) + 1))
+
+
+def pick_session(key, exclude=()):
+    """Choose the session for a lookup of `key` (see the pool comment above); None if all are benched."""
+    now = time.monotonic()
+    healthy = [sess for sess in tele_sessions if sess not in exclude and sess.healthy(now)]
+    if not healthy:
+        return None
+    # sess.key, not the index: reordering TELETHON_SESSIONS must not move groups
+    # away from the session whose stored access hashes they use
+    preferred = max(healthy, key=lambda sess: zlib.crc32(f"{key}|{sess.key}".encode()))
+    least = min(healthy, key=lambda sess: sess.load)
+    if preferred.load - least.load > SESSION_MAX_SKEW:
+        return least
+    return preferred
+
+
+async def tele_call(session, method, make_coro):
+    """Run make_coro() under `session`'s `method` bucket, sleeping through short FloodWaits."""
+    bucket = session.buckets[method]
+    fetch = fetch_priority.get() or FetchPriority(request_priority.get())
+    for attempt in range(FLOOD_RETRIES + 1):
+        await bucket.acquire(fetch)
+        try:
+            return await make_coro()
+        except FloodWaitError as e:
+            bucket.flood(e.seconds)
+            metrics.inc("groupbot_flood_waits_total", method=method)
+            logger.warning("FloodWait %ss on session %s %s (attempt %s)", e.seconds, session.index, method, attempt + 1)
+            if e.seconds > FLOOD_MAX_SLEEP or attempt == FLOOD_RETRIES:
+                if e.seconds > FLOOD_MAX_SLEEP:
+                    session.bench(e.seconds)
+                raise FloodWait(e.seconds)
+
+
+def scheduler_stats():
+    """Bucket stats per method class, summed over all sessions."""
+    out = {}
+    for sess in tele_sessions:
+        for name, bucket in sess.buckets.items():
+            st = bucket.stats()
+            agg = out.setdefault(name, {k: 0 for k in st})
+            for k, v in st.items():
+                agg[k] = max(agg[k], v) if k in ("wait_max", "blocked_for") else agg[k] + v
+    return out
+
+
+def session_stats():
+    return [(sess.index, sess.stats()) for sess in tele_sessions]
+
+
+# ---------------- Admission control ----------------
+# Two gates in front of the expensive work. Handler threads spend a token from
+# the user's bucket before anything is charged, and every Telegram fetch takes
+# a slot in fetch_gate: past FETCH_CONCURRENCY callers queue by priority, and
+# once the queue is full or the wait too long they are shed with Busy instead
+# of piling up behind the token buckets. A queued fetch moves up when a more
+# urgent request joins it, so the order is decided when a slot frees up.
+class Busy(Exception):
+    """Raised when a lookup is shed because too many are already waiting."""
+
+    def __init__(self):
+        super().__init__("The bot is busy right now, please try again in a moment")
+
+
+class UserRateLimiter:
+    def __init__(self, rate, burst, max_entries=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_entries = max_entries
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, user_id):
+        """Spend one of the user's tokens: 0 if allowed, else seconds until one is available."""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(user_id, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+            self._buckets[user_id] = (tokens - 1 if tokens >= 1 else tokens, now)
+            if len(self._buckets) > self.max_entries:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class FetchGate:
+    """Concurrency cap with a bounded priority queue; lives on the Telethon loop."""
+
+    def __init__(self, limit, queue_max, max_wait):
+        self.limit = limit
+        self.queue_max = queue_max
+        self.max_wait = max_wait
+        self.active = 0
+        self.avg_fetch = 1.0
+        self._waiters = deque()  # (FetchPriority, future), oldest first
+
+    def waiting(self):
+        return len(self._waiters)
+
+    def expected_wait(self):
+        if self.active < self.limit:
+            return 0.0
+        return (self.waiting() + 1) / self.limit * self.avg_fetch
+
+    def overloaded(self):
+        """Would a new fetch be shed? Also read from handler threads, so only an estimate."""
+        return self.waiting() >= self.queue_max or self.expected_wait() > self.max_wait
+
+    def _shed(self, reason):
+        metrics.inc("groupbot_admission_rejected_total", reason=reason)
+        raise Busy()
+
+    async def acquire(self, fetch):
+        if self.active < self.limit and not self.waiting():
+            self.active += 1
+            return
+        if fetch.value == PRIORITY_BACKGROUND:
+            self._shed("background")
+        if self.waiting() >= self.queue_max:
+            self._shed("queue_full")
+        fut = asyncio.get_running_loop().create_future()
+        entry = (fetch, fut)
+        self._waiters.append(entry)
+        metrics.inc("groupbot_admission_queued_total")
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(fut, self.max_wait)
+        except BaseException as e:
+            if fut.done() and not fut.cancelled():
+                self.release()  # the slot was handed over as we gave up: pass it on
+            if isinstance(e, asyncio.TimeoutError):
+                self._shed("queue_wait")
+            raise
+        finally:
+            if entry in self._waiters:
+                self._waiters.remove(entry)
+        metrics.observe("groupbot_admission_wait_seconds", time.monotonic() - started)
+
+    def release(self):
+        while self._waiters:
+            # most urgent first, oldest first within a priority (min keeps the first)
+            entry = min(self._waiters, key=lambda w: w[0].value)
+            self._waiters.remove(entry)
+            if not entry[1].done():
+                entry[1].set_result(None)  # hand the slot straight to the next waiter
+                return
+        self.active -= 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, fetch):
+        await self.acquire(fetch)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.avg_fetch += (time.monotonic() - started - self.avg_fetch) * 0.1
+            self.release()
+
+    def stats(self):
+        return {"active": self.active, "waiting": self.waiting(), "expected_wait": self.expected_wait()}
+
+
+user_limiter = UserRateLimiter(USER_RATE, USER_BURST)
+fetch_gate = FetchGate(FETCH_CONCURRENCY, FETCH_QUEUE_MAX, FETCH_QUEUE_WAIT)
+
+
+# ---------------- Database helpers ----------------
+# One long-lived connection per thread (PTB workers, the Telethon loop, ...).
+# WAL lets readers run alongside the writer, and sqlite3's per-connection
+# statement cache means the hot queries below are only prepared once.
+_db_local = threading.local()
+_db_conns = []
+# RETURNING lets writes hand back the updated row in the same statement;
+# older sqlite builds fall back to a SELECT in the same transaction.
+_SQLITE_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+_db_conns_lock = threading.Lock()
+
+
+def get_db():
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(
+            DATABASE,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            cached_statements=DB_STATEMENT_CACHE,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        _db_local.conn = conn
+        with _db_conns_lock:
+            _db_conns.append(conn)
+    return conn
+
+
+def close_db():
+    with _db_conns_lock:
+        conns = list(_db_conns)
+        _db_conns.clear()
+    for conn in conns:
+        try:
+            conn.close()
+        except sqlite3.ProgrammingError:
+            # created in another thread; it goes away with the process
+            pass
+    _db_local.conn = None
+
+
+# Schema migrations, applied in order and tracked in PRAGMA user_version.
+# Version 1 is the schema as it stood before versioning (everything IF NOT
+# EXISTS, so existing databases pass through it unchanged).
+MIGRATIONS = [
+    (
+        1,
+        [
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                credits INTEGER,
+                created_at INTEGER
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS stats (
+                key TEXT PRIMARY KEY,
+                value INTEGER
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS pending_credits (
+                username TEXT PRIMARY KEY,
+                credits INTEGER DEFAULT 0
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS entities (
+                session TEXT,
+                key TEXT,
+                id INTEGER,
+                access_hash INTEGER,
+                type TEXT,
+                title TEXT,
+                last_seen INTEGER,
+                PRIMARY KEY (session, key)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS id_calibration (
+                id INTEGER PRIMARY KEY,
+                ts INTEGER
+            )
+            """,
+            "INSERT OR IGNORE INTO stats(key, value) VALUES ('total_searches', 0)",
+        ],
+    ),
+    (
+        2,
+        [
+            # Telegram usernames are case-insensitive; lookups use COLLATE NOCASE
+            "CREATE INDEX IF NOT EXISTS idx_users_username ON users(username COLLATE NOCASE)",
+            "CREATE INDEX IF NOT EXISTS idx_pending_username ON pending_credits(username COLLATE NOCASE)",
+        ],
+    ),
+    (
+        3,
+        [
+            """
+            CREATE TABLE IF NOT EXISTS lookup_history (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER,
+                group_key TEXT,
+                group_id INTEGER,
+                title TEXT,
+                ts INTEGER
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_history_user ON lookup_history(user_id, ts)",
+            "CREATE INDEX IF NOT EXISTS idx_history_group ON lookup_history(group_key, ts)",
+        ],
+    ),
+    (
+        4,
+        [
+            # last known fetch_group_info_async result, under both the id and name keys
+            """
+            CREATE TABLE IF NOT EXISTS group_info (
+                key TEXT PRIMARY KEY,
+                id INTEGER,
+                info TEXT,
+                updated_at INTEGER
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_group_info_id ON group_info(id)",
+        ],
+    ),
+]
+
+
+def init_db():
+    conn = get_db()
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target, statements in MIGRATIONS:
+        if target <= version:
+            continue
+        with conn:
+            for sql in statements:
+                conn.execute(sql)
+            conn.execute(f"PRAGMA user_version={target}")
+        logger.info("Database migrated to schema version %s", target)
+
+
+@db_timed
 def get_user(user_id):
-    conn = sqlite3.connect(DATABASE)
-    cur = conn.cursor()
-    cur.execute("SELECT user_id, username, first_name, credits, created_at FROM users WHERE user_id=?", (user_id,))
-    row = cur.fetchone()
-    conn.close()
+    row = get_db().execute(
+        "SELECT user_id, username, first_name, credits, created_at FROM users WHERE user_id=?", (user_id,)
+    ).fetchone()
     if not row:
         return None
     return {"user_id": row[0], "username": row[1], "first_name": row[2], "credits": row[3], "created_at": row[4]}
 
 
+@db_timed
+def find_user_by_username(username):
+    row = get_db().execute(
+        "SELECT user_id, credits FROM users WHERE username=? COLLATE NOCASE", (username,)
+    ).fetchone()
+    return row
+
+
+@db_timed
 def create_user_if_missing(user_id, username, first_name):
     u = get_user(user_id)
     if u:
+        if username and u["username"] != username:
+            # keep usernames current so admin lookups by @username find people
+            conn = get_db()
+            with conn:
+                conn.execute(
+                    "UPDATE users SET username=?, first_name=? WHERE user_id=?", (username, first_name or "", user_id)
+                )
+            u["username"], u["first_name"] = username, first_name or ""
         return u
     now = int(time.time())
-    conn = sqlite3.connect(DATABASE)
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT OR REPLACE INTO users(user_id, username, first_name, credits, created_at) VALUES (?,?,?,?,?)",
-        (user_id, username or "", first_name or "", DEFAULT_CREDITS, now),
-    )
-    conn.commit()
-    conn.close()
-    # apply pending credits if username present
-    if username:
-        apply_pending_credit_for_username(username, user_id)
-    return get_user(user_id)
-
-
-def apply_pending_credit_for_username(username, user_id):
-    conn = sqlite3.connect(DATABASE)
-    cur = conn.cursor()
-    cur.execute("SELECT credits FROM pending_credits WHERE username=?", (username,))
-    row = cur.fetchone()
-    if row:
-        credits = row[0]
-        cur.execute("UPDATE users SET credits = credits + ? WHERE user_id=?", (credits, user_id))
-        cur.execute("DELETE FROM pending_credits WHERE username=?", (username,))
-        conn.commit()
-    conn.close()
-
-
+    conn = get_db()
+    with conn:
+        # a concurrent request may have created the row already: ON CONFLICT
+        # hands that row back instead of failing
+        params = (user_id, username or "", first_name or "", DEFAULT_CREDITS, now)
+        if _SQLITE_RETURNING:
+            row = conn.execute(
+                "INSERT INTO users(user_id, username, first_name, credits, created_at) VALUES (?,?,?,?,?) "
+                "ON CONFLICT(user_id) DO UPDATE SET username=excluded.username "
+                "RETURNING user_id, username, first_name, credits, created_at",
+                params,
+            ).fetchone()
+        else:
+            conn.execute(
+                "INSERT OR IGNORE INTO users(user_id, username, first_name, credits, created_at) VALUES (?,?,?,?,?)",
+                params,
+            )
+            row = conn.execute(
+                "SELECT user_id, username, first_name, credits, created_at FROM users WHERE user_id=?", (user_id,)
+            ).fetchone()
+        u = {"user_id": row[0], "username": row[1], "first_name": row[2], "credits": row[3], "created_at": row[4]}
+        # apply pending credits if username present
+        if username:
+            pending = conn.execute(
+                "SELECT username, credits FROM pending_credits WHERE username=? COLLATE NOCASE", (username,)
+            ).fetchone()
+            if pending:
+                conn.execute("UPDATE users SET credits = credits + ? WHERE user_id=?", (pending[1], user_id))
+                conn.execute("DELETE FROM pending_credits WHERE username=?", (pending[0],))
+                u["credits"] += pending[1]
+    return u
+
+
+@db_timed
 def add_credits_to_user_id(user_id, amount):
-    conn = sqlite3.connect(DATABASE)
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET credits = credits + ? WHERE user_id=?", (amount, user_id))
-    conn.commit()
-    conn.close()
+    conn = get_db()
+    with conn:
+        conn.execute("UPDATE users SET credits = credits + ? WHERE user_id=?", (amount, user_id))
 
 
+@db_timed
 def add_pending_credits_for_username(username, amount):
-    conn = sqlite3.connect(DATABASE)
-    cur = conn.cursor()
-    cur.execute("INSERT OR IGNORE INTO pending_credits(username, credits) VALUES (?,0)", (username,))
-    cur.execute("UPDATE pending_credits SET credits = credits + ? WHERE username=?", (amount, username))
-    conn.commit()
-    conn.close()
+    conn = get_db()
+    with conn:
+        row = conn.execute("SELECT username FROM pending_credits WHERE username=? COLLATE NOCASE", (username,)).fetchone()
+        if row:
+            username = row[0]
+        conn.execute("INSERT OR IGNORE INTO pending_credits(username, credits) VALUES (?,0)", (username,))
+        conn.execute("UPDATE pending_credits SET credits = credits + ? WHERE username=?", (amount, username))
+
+
+def _update_credits_returning(conn, sql, params, user_id):
+    if _SQLITE_RETURNING:
+        row = conn.execute(sql + " RETURNING credits", params).fetchone()
+        return row[0] if row else None
+    if conn.execute(sql, params).rowcount == 0:
+        return None
+    return conn.execute("SELECT credits FROM users WHERE user_id=?", (user_id,)).fetchone()[0]
+
+
+@db_timed
+def debit_credits(user_id, cost, stat_key="total_searches"):
+    """Atomically take `cost` credits if the balance allows it.
+
+    Returns (True, new_balance) or (False, current_balance_or_None). On
+    success `stat_key` is counted through the buffered stats.
+    """
+    conn = get_db()
+    with conn:
+        balance = _update_credits_returning(
+            conn,
+            "UPDATE users SET credits = credits - ? WHERE user_id=? AND credits >= ?",
+            (cost, user_id, cost),
+            user_id,
+        )
+        if balance is None:
+            row = conn.execute("SELECT credits FROM users WHERE user_id=?", (user_id,)).fetchone()
+            return False, (row[0] if row else None)
+    if stat_key:
+        increment_stat(stat_key)
+    return True, balance
 
 
 def try_consume_credits(user_id, cost):
-    user = get_user(user_id)
-    if not user:
+    ok, balance = debit_credits(user_id, cost)
+    if ok:
+        return True, None
+    if balance is None:
         return False, "User not found"
-    if user["credits"] < cost:
-        return False, f"Not enough credits. You have {user['credits']} credits."
-    conn = sqlite3.connect(DATABASE)
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET credits = credits - ? WHERE user_id=?", (cost, user_id))
-    conn.commit()
-    conn.close()
-    increment_stat("total_searches", 1)
-    return True, None
+    return False, f"Not enough credits. You have {balance} credits."
 
 
+@db_timed
 def refund_credits(user_id, amount):
-    add_credits_to_user_id(user_id, amount)
+    """Atomically give back `amount` credits; returns the new balance (None if no such user)."""
+    metrics.inc("groupbot_refunds_total")
+    conn = get_db()
+    with conn:
+        return _update_credits_returning(
+            conn, "UPDATE users SET credits = credits + ? WHERE user_id=?", (amount, user_id), user_id
+        )
+
+
+# Stat counters are buffered in memory and written in one transaction by
+# flush_stats() (a JobQueue job every STATS_FLUSH_INTERVAL and at shutdown),
+# so counting an event never costs a commit on the request path. A flush only
+# takes its amounts off the buffer once they are committed; _stat_flush_lock
+# keeps get_stat() from reading in between.
+_stat_deltas = {}
+_stat_lock = threading.Lock()
+_stat_flush_lock = threading.Lock()
 
 
 def increment_stat(key, amount=1):
-    conn = sqlite3.connect(DATABASE)
-    cur = conn.cursor()
-    cur.execute("INSERT OR IGNORE INTO stats(key, value) VALUES (?, ?)", (key, 0))
-    cur.execute("UPDATE stats SET value = value + ? WHERE key=?", (amount, key))
-    conn.commit()
-    conn.close()
+    with _stat_lock:
+        _stat_deltas[key] = _stat_deltas.get(key, 0) + amount
+
+
+@db_timed
+def flush_stats():
+    with _stat_flush_lock:
+        with _stat_lock:
+            pending = [(k, v) for k, v in _stat_deltas.items() if v]
+        if not pending:
+            return 0
+        conn = get_db()
+        # on an error the deltas stay buffered and the next flush retries them
+        with conn:
+            conn.executemany("INSERT OR IGNORE INTO stats(key, value) VALUES (?, 0)", [(k,) for k, _ in pending])
+            conn.executemany("UPDATE stats SET value = value + ? WHERE key=?", [(v, k) for k, v in pending])
+        with _stat_lock:
+            for key, amount in pending:
+                left = _stat_deltas[key] - amount  # increments made during the commit
+                if left:
+                    _stat_deltas[key] = left
+                else:
+                    del _stat_deltas[key]
+        return len(pending)
+
 
+def flush_stats_job(context: CallbackContext):
+    try:
+        flush_stats()
+    except sqlite3.Error as e:
+        logger.warning("Stats flush failed: %s", e)
 
+
+@db_timed
 def get_stat(key):
-    conn = sqlite3.connect(DATABASE)
-    cur = conn.cursor()
-    cur.execute("SELECT value FROM stats WHERE key=?", (key,))
-    row = cur.fetchone()
-    conn.close()
-    return row[0] if row else 0
+    with _stat_flush_lock:
+        row = get_db().execute("SELECT value FROM stats WHERE key=?", (key,)).fetchone()
+        with _stat_lock:
+            pending = _stat_deltas.get(key, 0)
+    return (row[0] if row else 0) + pending
+
+
+@db_timed
+def count_users():
+    return get_db().execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+
+USER_EXPORT_FIELDS = ["user_id", "username", "first_name", "credits", "created_at"]
+
+
+@db_timed
+def iter_users(created_after=None, min_credits=None, chunk_size=None):
+    """Yield user rows in chunks straight off the cursor, without loading the table."""
+    sql = "SELECT user_id, username, first_name, credits, created_at FROM users"
+    where, params = [], []
+    if created_after is not None:
+        where.append("created_at >= ?")
+        params.append(created_after)
+    if min_credits is not None:
+        where.append("credits > ?")
+        params.append(min_credits)
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    cur = get_db().cursor()
+    cur.execute(sql + " ORDER BY user_id", params)
+    try:
+        while True:
+            rows = cur.fetchmany(chunk_size or EXPORT_CHUNK_SIZE)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        cur.close()
+
+
+# ---------------- Entity store ----------------
+# Resolving an @username costs a contacts.ResolveUsername call, one of the
+# most flood-limited methods, and the StringSession entity cache is lost on
+# every restart. Resolved groups are kept in the `entities` table as
+# (id, access_hash, type) per session (access hashes are per account), so a
+# repeat lookup goes straight to channels.GetChannels. Name entries older than
+# ENTITY_REFRESH_AGE are resolved again in case the username moved. put()
+# runs on the Telethon loop, so its rows go through the persist writer queue.
+class EntityStore:
+    def __init__(self):
+        self._mem = {}
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "expired": 0, "invalid": 0}
+
+    @staticmethod
+    def _key(cache_key):
+        return _key_str(cache_key)
+
+    def prewarm(self, limit):
+        rows = get_db().execute(
+            "SELECT session, key, id, access_hash, type, title, last_seen FROM entities ORDER BY last_seen DESC LIMIT ?",
+            (limit,),
+        ).fetchall()
+        with self._lock:
+            for row in rows:
+                self._mem[(row[0], row[1])] = row[2:]
+        return len(rows)
+
+    def get(self, session_key, cache_key):
+        """(id, access_hash, type) for a usable cached entity, or None."""
+        with self._lock:
+            row = self._mem.get((session_key, self._key(cache_key)))
+            if row is None:
+                self.counters["misses"] += 1
+                return None
+            if cache_key[0] == "name" and time.time() - row[4] > ENTITY_REFRESH_AGE:
+                self.counters["expired"] += 1
+                return None
+            self.counters["hits"] += 1
+            return row[0], row[1], row[2]
+
+    def put(self, session_key, cache_keys, entity):
+        if isinstance(entity, Channel):
+            etype, access_hash = "channel", entity.access_hash
+        elif isinstance(entity, Chat):
+            etype, access_hash = "chat", None
+        else:
+            return
+        now = int(time.time())
+        row = (entity.id, access_hash, etype, getattr(entity, "title", None), now)
+        keys = {self._key(k) for k in cache_keys}
+        keys.add(self._key(("id", entity.id)))
+        with self._lock:
+            for key in keys:
+                self._mem[(session_key, key)] = row
+        for key in keys:
+            _persist(("entity", (session_key, key) + row))
+
+    def forget(self, session_key, cache_key):
+        with self._lock:
+            self._mem.pop((session_key, self._key(cache_key)), None)
+            self.counters["invalid"] += 1
+
+    def stats(self):
+        with self._lock:
+            out = dict(self.counters)
+            out["entries"] = len(self._mem)
+        return out
+
+
+entity_store = EntityStore()
+
+
+def _input_peer(cached):
+    entity_id, access_hash, etype = cached
+    if etype == "channel":
+        return InputPeerChannel(channel_id=entity_id, access_hash=access_hash)
+    return InputPeerChat(chat_id=entity_id)
+
+
+def _entity_usernames(entity):
+    """The entity's main username plus its active extra (and collectible) ones, lowercased."""
+    names = {u.username for u in getattr(entity, "usernames", None) or [] if u.active}
+    names.add(getattr(entity, "username", None))
+    return {name.lower() for name in names if name}
+
+
+# ---------------- Creation date estimator ----------------
+# Channel ids are handed out roughly in creation order, so a sorted table of
+# (id, creation time) pairs from groups we have already looked up lets us
+# interpolate a new group's creation date without touching its history.
+# Only exact observations are recorded: a visible message #1 is the service
+# message written when the channel was created (or a group was migrated).
+class CreationDateEstimator:
+    def __init__(self):
+        self._ids = []
+        self._ts = []
+        self._lock = threading.Lock()
+        self.counters = {"confident": 0, "unconfident": 0, "observations": 0}
+
+    def load(self):
+        rows = get_db().execute("SELECT id, ts FROM id_calibration ORDER BY id").fetchall()
+        with self._lock:
+            self._ids = [r[0] for r in rows]
+            self._ts = [r[1] for r in rows]
+        return len(rows)
+
+    def observe(self, entity_id, ts):
+        with self._lock:
+            i = bisect.bisect_left(self._ids, entity_id)
+            if i < len(self._ids) and self._ids[i] == entity_id:
+                if self._ts[i] <= ts:
+                    return
+                self._ts[i] = ts
+            else:
+                self._ids.insert(i, entity_id)
+                self._ts.insert(i, ts)
+            self.counters["observations"] += 1
+        # called on the Telethon loop: the row goes through the persist writer
+        _persist(("calibration", (entity_id, ts)))
+
+    def estimate(self, entity_id):
+        """(timestamp, spread_seconds, confident) for entity_id, or None with no data."""
+        with self._lock:
+            i = bisect.bisect_left(self._ids, entity_id)
+            if i < len(self._ids) and self._ids[i] == entity_id:
+                result = (self._ts[i], 0, True)
+            elif 0 < i < len(self._ids):
+                lo_id, hi_id = self._ids[i - 1], self._ids[i]
+                lo_ts, hi_ts = self._ts[i - 1], self._ts[i]
+                ts = lo_ts + (hi_ts - lo_ts) * (entity_id - lo_id) / (hi_id - lo_id)
+                spread = abs(hi_ts - lo_ts)
+                result = (int(ts), spread, spread <= ESTIMATE_MAX_SPAN)
+            elif self._ids:
+                # outside the calibrated range: nearest point is only a bound
+                j = 0 if i == 0 else len(self._ids) - 1
+                result = (self._ts[j], None, False)
+            else:
+                return None
+            self.counters["confident" if result[2] else "unconfident"] += 1
+        return result
 
+    def stats(self):
+        with self._lock:
+            out = dict(self.counters)
+            out["points"] = len(self._ids)
+        return out
 
-def get_all_users():
-    conn = sqlite3.connect(DATABASE)
-    cur = conn.cursor()
-    cur.execute("SELECT user_id, username, first_name, credits, created_at FROM users")
-    rows = cur.fetchall()
-    conn.close()
-    return rows
 
+date_estimator = CreationDateEstimator()
 
-# ---------------- Utility: normalize group input ----------------
-import re
 
-GROUP_LINK_RE = re.compile(r"(t\.me/|telegram\.me/)?@?([A-Za-z0-9_]+)")
-INVITE_RE = re.compile(r"(https?://)?t\.me/joinchat/([A-Za-z0-9_-]+)")
+# ---------------- Utility: normalize group input ----------------
+# Every reference is classified once, up front, into a GroupTarget so that a
+# malformed input or an invite link never costs a doomed ResolveUsername:
+#   username  @name, name                      value "@name"
+#   id        123, -100123                     value int
+#   link      t.me/name, tg://resolve?domain=  value "@name"
+#   invite    t.me/+hash, t.me/joinchat/hash   value hash (case sensitive)
+#   message   t.me/name/42, t.me/c/123/42      value "@name" or -100 id, message_id 42
+GroupTarget = namedtuple("GroupTarget", "kind value message_id")
+
+_USERNAME = r"[A-Za-z][A-Za-z0-9_]{3,31}"
+GROUP_INPUT_RE = re.compile(
+    rf"""
+      @?(?P<username>{_USERNAME})
+    | (?P<id>-?\d+)
+    | tg://resolve\?domain=(?P<domain>{_USERNAME})(?:&\S*)?
+    | (?:https?://)?(?:www\.)?(?:t\.me|telegram\.(?:me|dog))/
+      (?:
+          (?:joinchat/|\+)(?P<invite>[A-Za-z0-9_-]{{8,}})
+        | c/(?P<channel>\d+)(?:/(?P<channel_msg>\d+))?
+        | (?:s/)?(?P<link>{_USERNAME})(?:/(?P<link_msg>\d+))?
+      )
+      /?(?:[?#]\S*)?
+    """,
+    re.VERBOSE | re.IGNORECASE,
+)
 
 
-def normalize_group_input(text):
+def parse_group_input(text):
+    """GroupTarget for a group reference, or None if text is not one."""
     if not text:
         return None
-    text = text.strip()
-    try:
-        if text.startswith("-100") or text.lstrip("-").isdigit():
-            return int(text)
-    except Exception:
-        pass
-    m = GROUP_LINK_RE.search(text)
-    if m:
-        return "@" + m.group(2)
-    m2 = INVITE_RE.search(text)
-    if m2:
-        return text
-    return text
+    m = GROUP_INPUT_RE.fullmatch(text.strip())
+    if m is None:
+        return None
+    kind = m.lastgroup
+    if kind == "username":
+        return GroupTarget("username", "@" + m["username"], None)
+    if kind == "id":
+        return GroupTarget("id", int(m["id"]), None)
+    if kind in ("domain", "link"):
+        return GroupTarget("link", "@" + m[kind], None)
+    if kind == "invite":
+        return GroupTarget("invite", m["invite"], None)
+    if kind == "channel":
+        return GroupTarget("id", int("-100" + m["channel"]), None)
+    if kind == "channel_msg":
+        return GroupTarget("message", int("-100" + m["channel"]), int(m["channel_msg"]))
+    return GroupTarget("message", "@" + m["link"], int(m["link_msg"]))
+
+
+def target_input(target):
+    """The value to resolve for a GroupTarget: int id, "@username" or "+invitehash"."""
+    if target.kind == "invite":
+        return "+" + target.value
+    return target.value
 
 
-# ---------------- Core: fetch group info via Telethon ----------------
-def fetch_group_info(group_input):
-    import asyncio
+def normalize_group_input(text):
+    """target_input() of the parsed text; None if it is not a group reference."""
+    target = parse_group_input(text)
+    return target_input(target) if target is not None else None
 
-    # ✅ Fix for "no current event loop" error
+
+# ---------------- Core: fetch group info via Telethon ----------------
+STEP_LABELS = {
+    "full_channel": "member count",
+    "oldest_message": "oldest message",
+    "admins": "admin list",
+}
+STEP_FIELDS = {
+    "full_channel": ("member_count",),
+    "oldest_message": (),
+    "admins": ("admins", "admin_count", "owner"),
+}
+
+
+async def _timed_step(name, coro, timeout, timings, timed_out):
+    """Await one fetch step, recording its duration; errors and timeouts are swallowed."""
+    started = time.perf_counter()
     try:
-        asyncio.get_running_loop()
-    except RuntimeError:
-        asyncio.set_event_loop(asyncio.new_event_loop())
+        await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        timed_out.append(name)
+    except Exception as e:
+        logger.debug("fetch step %s failed: %s", name, e)
+    finally:
+        timings[name] = time.perf_counter() - started
 
-    # Ensure Telethon is connected
-    if not tele_client.is_connected():
-        tele_client.connect()
 
-    inp = normalize_group_input(group_input)
+def _invite_preview(invite, timings):
+    """Result for an invite to a group the session has not joined: only the preview is visible."""
+    if getattr(invite, "broadcast", False):
+        entity_type = "channel"
+    else:
+        entity_type = "supergroup" if getattr(invite, "megagroup", False) else "group"
+    return {
+        "group": invite.title,
+        "id": None,
+        "type": entity_type,
+        "member_count": getattr(invite, "participants_count", None),
+        "approx_date": "Unknown",
+        "method": "Unknown",
+        "owner": "Unknown",
+        "admins": [],
+        "admin_count": 0,
+        "note": "Invite preview only: the lookup account is not a member of this group.",
+        "timings": timings,
+        "partial": [],
+        "as_of": int(time.time()),
+    }
 
-    # Run Telethon call safely in sync code
-    try:
-        entity = asyncio.get_event_loop().run_until_complete(
-            tele_client.get_entity(inp)
-        )
-    except Exception as e:
-        raise Exception(f"Could not resolve group: {e}")
+
+class GroupNotFound(Exception):
+    """The group doesn't exist or can't be seen; negatively cached, unlike other errors."""
+
+
+async def fetch_group_info_async(group_input, session=None):
+    inp = normalize_group_input(group_input)
+    if inp is None:
+        raise GroupNotFound("Could not resolve group: expected a @username, id or t.me link")
+    if session is None:
+        session = pick_session(_cache_key(inp))
+        if session is None:
+            raise benched_error()
+    client = session.client
+    await session.ensure_connected()
+
+    timings = {}
+
+    started = time.perf_counter()
+    entity = None
+    key = _cache_key(inp)
+    cached = entity_store.get(session.key, key)
+    if cached:
+        # known access hash: channels.GetChannels instead of ResolveUsername
+        try:
+            entity = await tele_call(session, "channels", lambda: client.get_entity(_input_peer(cached)))
+        except FloodWait:
+            raise
+        except Exception as e:
+            logger.info("Stored entity for %s no longer valid: %s", inp, e)
+            entity_store.forget(session.key, key)
+        if entity is not None and key[0] == "name" and key[1].lstrip("@") not in _entity_usernames(entity):
+            entity_store.forget(session.key, key)
+            entity = None
+    if entity is None:
+        # invite hashes are not usernames: ask about the invite instead
+        invite = key[0] == "invite"
+        try:
+            entity = await tele_call(
+                session,
+                "resolve",
+                lambda: client(CheckChatInviteRequest(key[1])) if invite else client.get_entity(inp),
+            )
+        except FloodWait:
+            raise
+        except GROUP_NOT_FOUND_ERRORS as e:
+            raise GroupNotFound(f"Could not resolve group: {e}")
+        except Exception as e:
+            # connection trouble, Telegram 5xx, ...: fail this lookup, don't cache it
+            raise Exception(f"Could not resolve group: {e}")
+        if isinstance(entity, (ChatInviteAlready, ChatInvitePeek)):
+            entity = entity.chat
+        elif isinstance(entity, ChatInvite):
+            timings["resolve"] = time.perf_counter() - started
+            return _invite_preview(entity, timings)
+        entity_store.put(session.key, [key], entity)
+    timings["resolve"] = time.perf_counter() - started
 
     title = getattr(entity, "title", str(entity))
     gid = getattr(entity, "id", None)
@@ -286,56 +1575,81 @@ def fetch_group_info(group_input):
         "method": None,
         "owner": "Unknown",
         "admins": [],
+        "admin_count": 0,
         "note": None,
+        "timings": timings,
+        "partial": [],
+        "as_of": int(time.time()),
     }
 
-    # Member count via GetFullChannel if possible
-    try:
-        from telethon.tl.functions.channels import GetFullChannelRequest
-
+    # The remaining steps are independent: run them concurrently, each with
+    # its own timeout, so one slow step only costs a partial answer.
+    async def member_count_step():
         if isinstance(entity, Channel):
             try:
-                full = tele_client.loop.run_until_complete(
-                    tele_client(GetFullChannelRequest(channel=entity))
-                )
+                full = await tele_call(session, "full_channel", lambda: client(GetFullChannelRequest(channel=entity)))
                 cnt = getattr(full.full_chat, "participants_count", None)
                 res["member_count"] = cnt or getattr(entity, "participants_count", None)
             except Exception:
                 res["member_count"] = getattr(entity, "participants_count", None)
         else:
-            res["member_count"] = None
-    except Exception:
-        res["member_count"] = getattr(entity, "participants_count", None)
+            res["member_count"] = getattr(entity, "participants_count", None)
 
-    # Oldest visible message
-    try:
-        msg = asyncio.get_event_loop().run_until_complete(
-            tele_client.iter_messages(entity, reverse=True, limit=1).__anext__()
-        )
-        if msg and getattr(msg, "date", None):
-            res["approx_date"] = msg.date.strftime("%Y-%m-%d %H:%M:%S")
-            res["method"] = "Oldest Visible Message"
-            res["note"] = "Based on first visible message (may not be exact creation date)."
-    except Exception:
-        pass
+    # A confident id-table estimate replaces the history probe entirely.
+    estimate = date_estimator.estimate(gid) if isinstance(entity, Channel) and gid else None
+    if estimate and estimate[2]:
+        res["approx_date"] = datetime.utcfromtimestamp(estimate[0]).strftime("%Y-%m-%d")
+        res["method"] = "ID Calibration"
+        res["note"] = f"Interpolated from groups with nearby ids (±{estimate[1] // 86400 + 1} days)."
 
-    # Admins + Owner
-    try:
-        admins = []
-        async def fetch_admins():
-            async for admin in tele_client.iter_participants(entity, filter=ChannelParticipantsAdmins):
-                name = " ".join(filter(None, [admin.first_name, admin.last_name])) or admin.username or f"id{admin.id}"
-                admins.append(name)
-
-        tele_client.loop.run_until_complete(fetch_admins())
+    async def oldest_message_step():
+        if res["approx_date"]:
+            return
 
-        res["admins"] = admins
-        if admins:
-            res["owner"] = admins[0]
-    except Exception:
-        pass
+        async def probe():
+            async for msg in client.iter_messages(entity, reverse=True, limit=1):
+                if getattr(msg, "date", None):
+                    res["approx_date"] = msg.date.strftime("%Y-%m-%d %H:%M:%S")
+                    res["method"] = "Oldest Visible Message"
+                    res["note"] = "Based on first visible message (may not be exact creation date)."
+                    if msg.id == 1 and isinstance(entity, Channel):
+                        date_estimator.observe(gid, int(msg.date.timestamp()))
+
+        await tele_call(session, "history", probe)
+
+    async def admins_step():
+        # Stream the admin list: keep the first ADMIN_LIST_CAP names, spot the
+        # creator from the participant rights in the same pass, and stop once
+        # the cap is reached and the creator is known (or ADMIN_SCAN_LIMIT hit).
+        # res is filled as we go so a timeout still keeps what was seen.
+        async def collect():
+            res["admins"] = []
+            res["admin_count"] = 0
+            it = client.iter_participants(entity, filter=ChannelParticipantsAdmins, limit=ADMIN_SCAN_LIMIT)
+            async for admin in it:
+                res["admin_count"] = max(res["admin_count"] + 1, getattr(it, "total", None) or 0)
+                name = " ".join(filter(None, [admin.first_name, admin.last_name])) or admin.username or f"id{admin.id}"
+                if isinstance(getattr(admin, "participant", None), (ChannelParticipantCreator, ChatParticipantCreator)):
+                    res["owner"] = name
+                if len(res["admins"]) < ADMIN_LIST_CAP:
+                    res["admins"].append(name)
+                elif res["owner"] != "Unknown":
+                    break
+
+        await tele_call(session, "participants", collect)
+
+    timed_out = []
+    await asyncio.gather(
+        _timed_step("full_channel", member_count_step(), STEP_TIMEOUT_FULL, timings, timed_out),
+        _timed_step("oldest_message", oldest_message_step(), STEP_TIMEOUT_HISTORY, timings, timed_out),
+        _timed_step("admins", admins_step(), STEP_TIMEOUT_ADMINS, timings, timed_out),
+    )
 
-    # Fallback: Estimate by group ID range
+    # Fallback: unconfident table estimate, then the coarse id ranges
+    if not res["approx_date"] and estimate:
+        res["approx_date"] = "~" + datetime.utcfromtimestamp(estimate[0]).strftime("%Y-%m")
+        res["method"] = "ID Calibration"
+        res["note"] = "Rough estimate from the nearest known group ids."
     if not res["approx_date"]:
         try:
             gid_abs = abs(int(res["id"])) if res["id"] else None
@@ -358,24 +1672,874 @@ def fetch_group_info(group_input):
             res["approx_date"] = "Unknown"
             res["method"] = "Unknown"
 
+    res["partial"] = timed_out
+    if timed_out:
+        partial = "Partial result: " + ", ".join(STEP_LABELS[name] for name in timed_out) + " timed out."
+        res["note"] = f"{res['note']} {partial}" if res["note"] else partial
+
+    for stage, secs in timings.items():
+        metrics.observe("groupbot_fetch_stage_seconds", secs, stage=stage)
+    for stage in timed_out:
+        metrics.inc("groupbot_fetch_stage_timeouts_total", stage=stage)
+    logger.debug(
+        "fetch_group_info_async %s: %s",
+        inp,
+        " ".join(f"{name}={secs * 1000:.0f}ms" for name, secs in timings.items()),
+    )
     return res
 
 
+# ---------------- Group info cache ----------------
+# Per-field TTLs: None means the value never goes stale (oldest message date
+# and the id-range estimate don't change once known).
+CACHE_FIELD_TTLS = {
+    "member_count": CACHE_TTL_MEMBERS,
+    "admins": CACHE_TTL_ADMINS,
+    "admin_count": CACHE_TTL_ADMINS,
+    "owner": CACHE_TTL_ADMINS,
+    "group": CACHE_TTL_META,
+    "type": CACHE_TTL_META,
+    "approx_date": None,
+    "method": None,
+    "note": None,
+}
+
+
+def _cache_key(inp):
+    """Cache key for a normalized group input (or a resolved entity id)."""
+    if isinstance(inp, int):
+        s = str(inp)
+        if s.startswith("-100"):
+            return ("id", int(s[4:]))
+        return ("id", abs(inp))
+    inp = str(inp)
+    if inp.startswith("+"):
+        return ("invite", inp[1:])
+    return ("name", inp.lower())
+
+
+def _key_str(cache_key):
+    """Cache key as stored in the database ("name:@foo", "id:123")."""
+    return f"{cache_key[0]}:{cache_key[1]}"
+
+
+class GroupInfoCache:
+    """LRU cache of fetch_group_info_async results with per-field TTLs.
+
+    Entries are stored under the resolved numeric id; the normalized input
+    (e.g. "@name") is kept as an alias pointing at that id. Groups that don't
+    exist (GroupNotFound) are remembered for CACHE_NEGATIVE_TTL seconds.
+    """
+
+    def __init__(self, max_entries, field_ttls, stale_max, negative_ttl):
+        self.max_entries = max_entries
+        self.field_ttls = field_ttls
+        self.stale_max = stale_max
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._aliases = {}
+        self._negative = {}
+        self._lock = threading.Lock()
+        self.counters = {
+            "hits": 0,
+            "stale_hits": 0,
+            "misses": 0,
+            "negative_hits": 0,
+            "evictions": 0,
+            "refreshes": 0,
+            "disk_hits": 0,
+        }
+
+    def _is_fresh(self, entry, now):
+        for field, ttl in self.field_ttls.items():
+            if ttl is not None and now - entry["fetched"].get(field, 0) > ttl:
+                return False
+        return True
+
+    def lookup(self, key):
+        """Return (state, value): ("fresh"|"stale", info), ("negative", error) or (None, None)."""
+        now = time.time()
+        with self._lock:
+            neg = self._negative.get(key)
+            if neg:
+                if neg[0] > now:
+                    self.counters["negative_hits"] += 1
+                    return "negative", neg[1]
+                del self._negative[key]
+            id_key = self._aliases.get(key, key)
+            entry = self._entries.get(id_key)
+            if entry is None or now - entry["stored"] > self.stale_max:
+                if entry is not None:
+                    self._drop(id_key)
+                self.counters["misses"] += 1
+                return None, None
+            self._entries.move_to_end(id_key)
+            if self._is_fresh(entry, now):
+                self.counters["hits"] += 1
+                return "fresh", dict(entry["info"])
+            self.counters["stale_hits"] += 1
+            return "stale", dict(entry["info"])
+
+    def store(self, key, info, fetched_at=None):
+        now = time.time()
+        fetched_at = fetched_at or now
+        id_key = _cache_key(info["id"]) if info.get("id") is not None else key
+        with self._lock:
+            self._negative.pop(key, None)
+            old = self._entries.get(id_key)
+            info = dict(info)
+            if old and old["info"].get("method") == "Oldest Visible Message" and info.get("method") != "Oldest Visible Message":
+                # keep the precise (permanent) date from an earlier fetch
+                for field in ("approx_date", "method", "note"):
+                    info[field] = old["info"].get(field)
+            aliases = old["aliases"] if old else set()
+            if key != id_key:
+                aliases.add(key)
+                self._aliases[key] = id_key
+            fetched = {field: fetched_at for field in self.field_ttls}
+            for step in info.get("partial") or ():
+                # timed-out fields are served but refreshed on the next hit
+                for field in STEP_FIELDS.get(step, ()):
+                    fetched[field] = 0
+            self._entries[id_key] = {
+                "info": info,
+                "fetched": fetched,
+                "stored": fetched_at,
+                "aliases": aliases,
+            }
+            self._entries.move_to_end(id_key)
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self.counters["evictions"] += 1
+
+    def expires_in(self, key):
+        """Seconds until the first field of a cached entry goes stale (<= 0: stale), None if not cached."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(self._aliases.get(key, key))
+            if entry is None:
+                return None
+            return min(
+                (entry["fetched"].get(field, 0) + ttl - now for field, ttl in self.field_ttls.items() if ttl is not None),
+                default=float("inf"),
+            )
+
+    def is_negative(self, key):
+        """True while a failed resolution of key is remembered."""
+        with self._lock:
+            neg = self._negative.get(key)
+            return neg is not None and neg[0] > time.time()
+
+    def contains(self, key):
+        """True if lookup(key) would answer without a fetch; leaves the counters alone."""
+        now = time.time()
+        with self._lock:
+            neg = self._negative.get(key)
+            if neg and neg[0] > now:
+                return True
+            entry = self._entries.get(self._aliases.get(key, key))
+            return entry is not None and now - entry["stored"] <= self.stale_max
+
+    def store_negative(self, key, error):
+        with self._lock:
+            self._negative[key] = (time.time() + self.negative_ttl, error)
+            if len(self._negative) > self.max_entries:
+                now = time.time()
+                for k in [k for k, v in self._negative.items() if v[0] <= now]:
+                    del self._negative[k]
+
+    def _drop(self, id_key):
+        entry = self._entries.pop(id_key, None)
+        if entry:
+            for alias in entry["aliases"]:
+                if self._aliases.get(alias) == id_key:
+                    del self._aliases[alias]
+
+    def dump(self):
+        """JSON-friendly copy of the entries, least recently used first."""
+        with self._lock:
+            return [
+                [list(id_key), e["info"], e["fetched"], e["stored"], [list(a) for a in e["aliases"]]]
+                for id_key, e in self._entries.items()
+            ]
+
+    def restore(self, items):
+        """Load entries written by dump(), keeping their original fetch times."""
+        now = time.time()
+        restored = 0
+        with self._lock:
+            for id_key, info, fetched, stored, aliases in items:
+                id_key = tuple(id_key)
+                if now - stored > self.stale_max or id_key in self._entries:
+                    continue
+                aliases = {tuple(a) for a in aliases}
+                self._entries[id_key] = {"info": info, "fetched": fetched, "stored": stored, "aliases": aliases}
+                for alias in aliases:
+                    self._aliases[alias] = id_key
+                restored += 1
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+        return restored
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def stats(self):
+        with self._lock:
+            out = dict(self.counters)
+            out["entries"] = len(self._entries)
+        return out
+
+
+group_cache = GroupInfoCache(CACHE_MAX_ENTRIES, CACHE_FIELD_TTLS, CACHE_STALE_MAX, CACHE_NEGATIVE_TTL)
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+async def _fetch_on_pool(group_input, key):
+    """fetch_group_info_async on the best session, moving on to the next one on FloodWait."""
+    tried = []
+    last_error = None
+    while True:
+        session = pick_session(key, exclude=tried)
+        if session is None:
+            # every (remaining) session is benched: fail fast
+            raise last_error or benched_error()
+        tried.append(session)
+        session.load += 1
+        session.counters["fetches"] += 1
+        try:
+            return await fetch_group_info_async(group_input, session)
+        except FloodWait as e:
+            session.counters["errors"] += 1
+            last_error = e
+        except Exception:
+            session.counters["errors"] += 1
+            raise
+        finally:
+            session.load -= 1
+
+
+async def _fetch_and_store_once(group_input, key, fetch):
+    fetch_priority.set(fetch)  # the task runs in its own copy of the context
+    try:
+        async with fetch_gate.slot(fetch):
+            info = await _fetch_on_pool(group_input, key)
+    except Exception as e:
+        kind = "flood" if isinstance(e, FloodWait) else "busy" if isinstance(e, Busy) else "other"
+        metrics.inc("groupbot_lookup_errors_total", kind=kind)
+        if isinstance(e, GroupNotFound):
+            group_cache.store_negative(key, str(e))
+        raise
+    group_cache.store(key, info)
+    persist_group_info(key, info)
+    return info
+
+
+# Single-flight: concurrent lookups of the same group share one fetch, run at
+# the priority of the most urgent of them. Only touched from the Telethon
+# loop, so no lock is needed.
+_inflight = {}  # key -> (task, FetchPriority)
+coalesce_counters = {"fetches": 0, "coalesced": 0}
+
+
+def _inflight_done(key, task):
+    if _inflight.get(key, (None,))[0] is task:
+        del _inflight[key]
+    if not task.cancelled():
+        task.exception()  # retrieved here in case every waiter was cancelled
+
+
+async def _fetch_and_store(group_input, key):
+    if key in _inflight:
+        task, fetch = _inflight[key]
+        fetch.join(request_priority.get())
+        coalesce_counters["coalesced"] += 1
+    else:
+        fetch = FetchPriority(request_priority.get())
+        task = asyncio.ensure_future(_fetch_and_store_once(group_input, key, fetch))
+        _inflight[key] = task, fetch
+        task.add_done_callback(lambda t: _inflight_done(key, t))
+        coalesce_counters["fetches"] += 1
+    # shield: a cancelled waiter (superseded inline query) must not cancel
+    # the fetch other requests are waiting on
+    info = await asyncio.shield(task)
+    return dict(info)
+
+
+def _refresh_in_background(group_input, key):
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+
+    def done(fut):
+        with _refreshing_lock:
+            _refreshing.discard(key)
+        try:
+            fut.result()
+        except Exception as e:
+            logger.info("Background refresh of %s failed: %s", group_input, e)
+            return
+        group_cache.count("refreshes")
+
+    async def refresh():
+        request_priority.set(PRIORITY_BACKGROUND)
+        return await _fetch_and_store(group_input, key)
+
+    submit_tele(refresh()).add_done_callback(done)
+
+
+def cached_group_info(group_input):
+    """Cache-only lookup returning (state, info); state is None on a miss.
+
+    Never waits on Telegram, but a stale hit still schedules a refresh.
+    """
+    inp = normalize_group_input(group_input)
+    if inp is None:
+        return None, None
+    key = _cache_key(inp)
+    state, value = group_cache.lookup(key)
+    if state == "negative":
+        return None, None
+    if state == "stale":
+        _refresh_in_background(group_input, key)
+    return state, value
+
+
+async def get_group_info_async(group_input, priority=PRIORITY_CHECK, force=False):
+    """Cached fetch_group_info_async: stale entries are served while a refresh runs.
+
+    Memory misses fall back to the group_info table; force=True skips both.
+    """
+    request_priority.set(priority)
+    inp = normalize_group_input(group_input)
+    if inp is None:
+        raise GroupNotFound("Could not resolve group: expected a @username, id or t.me link")
+    key = _cache_key(inp)
+    if force:
+        return await _fetch_and_store(group_input, key)
+    state, value = group_cache.lookup(key)
+    # the SELECT runs on the default executor (get_db is per thread), not the loop
+    if state is None and await asyncio.get_running_loop().run_in_executor(None, load_group_info, key):
+        state, value = group_cache.lookup(key)
+    if state == "negative":
+        raise Exception(value)
+    if state == "stale":
+        _refresh_in_background(group_input, key)
+    if state is not None:
+        return value
+    return await _fetch_and_store(group_input, key)
+
+
+def get_group_info(group_input, force=False):
+    return run_tele(get_group_info_async(group_input, force=force))
+
+
+# ---------------- Group result store ----------------
+# Completed lookups are written to the group_info table and each user's
+# lookups to lookup_history, so a restart or cache eviction doesn't lose
+# them and /history, /topgroups have something to show. These writes, and
+# the other ones made on the Telethon loop (stored entities, creation date
+# calibration points), go through a queue drained by one writer thread in
+# batches; neither the loop nor the reply path waits on them (a full queue
+# drops the write rather than blocking).
+PERSIST_SQL = {
+    "group": "INSERT OR REPLACE INTO group_info(key, id, info, updated_at) VALUES (?,?,?,?)",
+    "history": "INSERT INTO lookup_history(user_id, group_key, group_id, title, ts) VALUES (?,?,?,?,?)",
+    "entity": "INSERT OR REPLACE INTO entities(session, key, id, access_hash, type, title, last_seen) VALUES (?,?,?,?,?,?,?)",
+    "calibration": "INSERT OR REPLACE INTO id_calibration(id, ts) VALUES (?, ?)",
+}
+_persist_queue = queue.Queue(maxsize=PERSIST_QUEUE_MAX)
+_persist_thread = None
+_persist_lock = threading.Lock()
+
+
+def _persist_worker():
+    while True:
+        item = _persist_queue.get()
+        batch = [item]
+        while len(batch) < 500:
+            try:
+                batch.append(_persist_queue.get_nowait())
+            except queue.Empty:
+                break
+        stop = None in batch
+        try:
+            conn = get_db()
+            with conn:
+                for kind, sql in PERSIST_SQL.items():
+                    rows = [b[1] for b in batch if b and b[0] == kind]
+                    if rows:
+                        conn.executemany(sql, rows)
+        except sqlite3.Error as e:
+            logger.warning("Persisting %s rows failed: %s", len(batch), e)
+        if stop:
+            return
+
+
+def _persist(item):
+    global _persist_thread
+    if _persist_thread is None:
+        with _persist_lock:
+            if _persist_thread is None:
+                _persist_thread = threading.Thread(target=_persist_worker, name="persist-writer", daemon=True)
+                _persist_thread.start()
+    try:
+        _persist_queue.put_nowait(item)
+    except queue.Full:
+        increment_stat("persist_dropped")
+
+
+def stop_persist_writer():
+    global _persist_thread
+    if _persist_thread is None:
+        return
+    _persist_queue.put(None)
+    _persist_thread.join(timeout=30)
+    _persist_thread = None
+
+
+def persist_group_info(key, info):
+    data = json.dumps({k: v for k, v in info.items() if k != "timings"}, default=str)
+    updated = int(info.get("as_of") or time.time())
+    keys = {_key_str(key)}
+    if info.get("id") is not None:
+        keys.add(_key_str(("id", info["id"])))
+    for k in keys:
+        _persist(("group", (k, info.get("id"), data, updated)))
+
+
+def record_lookup(user_id, group_input, info):
+    inp = normalize_group_input(group_input)
+    key = _key_str(_cache_key(inp)) if inp is not None else str(group_input)
+    _persist(("history", (user_id, key, info.get("id"), info.get("group"), int(time.time()))))
+
+
+@db_timed
+def load_group_info(key):
+    """Load a stored result into group_cache (with its original age); True if found."""
+    row = get_db().execute(
+        "SELECT info, updated_at FROM group_info WHERE key=?", (_key_str(key),)
+    ).fetchone()
+    if not row or time.time() - row[1] > GROUP_STORE_MAX_AGE:
+        return False
+    info = json.loads(row[0])
+    info["as_of"] = row[1]
+    group_cache.store(key, info, fetched_at=row[1])
+    group_cache.count("disk_hits")
+    return True
+
+
+@db_timed
+def get_user_history(user_id, limit=10):
+    return get_db().execute(
+        "SELECT group_key, group_id, title, ts FROM lookup_history WHERE user_id=? ORDER BY ts DESC LIMIT ?",
+        (user_id, limit),
+    ).fetchall()
+
+
+@db_timed
+def get_top_groups(since, limit=10):
+    return get_db().execute(
+        "SELECT COALESCE(MAX(title), group_key), group_id, COUNT(*) AS n FROM lookup_history "
+        "WHERE ts >= ? GROUP BY COALESCE(group_id, group_key) ORDER BY n DESC LIMIT ?",
+        (since, limit),
+    ).fetchall()
+
+
+# ---------------- Hot group refresher ----------------
+# Each user request (/check, inline lookup, bulk item) bumps a per-group
+# score that halves every HOT_HALF_LIFE seconds. A JobQueue job refreshes
+# the top groups whose cached entry is about to go stale, one at a time at PRIORITY_BACKGROUND, so /check for them is served
+# fresh from the cache. It only starts when the fetch gate is idle, stops as
+# soon as users are waiting, and fetch_gate sheds its fetches under load.
+class HotGroups:
+    def __init__(self, half_life, max_tracked):
+        self.half_life = half_life
+        self.max_tracked = max_tracked
+        self._scores = {}
+        self._lock = threading.Lock()
+        self._running = False
+        self.counters = {"runs": 0, "refreshed": 0, "failed": 0, "skipped_busy": 0}
+
+    def _decayed(self, score, updated, now):
+        return score * 0.5 ** ((now - updated) / self.half_life)
+
+    def record(self, key, group_input, weight=1.0, now=None):
+        now = now or time.time()
+        with self._lock:
+            score, updated, _ = self._scores.get(key, (0.0, now, None))
+            self._scores[key] = (self._decayed(score, updated, now) + weight, now, group_input)
+            if len(self._scores) > self.max_tracked:
+                self._prune(now)
+
+    def record_input(self, group_input):
+        """Count one user request for group_input (called once per request by the handlers)."""
+        inp = normalize_group_input(group_input)
+        if inp is not None:
+            self.record(_cache_key(inp), group_input)
+
+    def _prune(self, now):
+        ranked = sorted(self._scores.items(), key=lambda kv: self._decayed(kv[1][0], kv[1][1], now), reverse=True)
+        self._scores = dict(ranked[: self.max_tracked * 9 // 10])
+
+    def top(self, n):
+        """[(key, group_input, score)] for the n hottest groups."""
+        now = time.time()
+        with self._lock:
+            scored = [(key, inp, self._decayed(score, updated, now)) for key, (score, updated, inp) in self._scores.items()]
+        return heapq.nlargest(n, scored, key=lambda item: item[2])
+
+    def load(self, window=None):
+        """Seed the scores from recent lookup_history so a restart starts warm."""
+        since = int(time.time()) - (window or self.half_life * 4)
+        rows = get_db().execute(
+            "SELECT group_key, COUNT(*), MAX(ts) FROM lookup_history WHERE ts >= ? GROUP BY group_key",
+            (since,),
+        ).fetchall()
+        for key_str, count, last in rows:
+            kind, _, value = key_str.partition(":")
+            if kind == "name":
+                group_input = value
+            elif kind == "id" and value.isdigit():
+                group_input = f"-100{value}"
+            elif kind == "invite":
+                group_input = f"https://t.me/+{value}"
+            else:
+                continue
+            inp = normalize_group_input(group_input)
+            if inp is not None:
+                self.record(_cache_key(inp), group_input, count, now=last)
+        return len(rows)
+
+    def due(self, n, horizon):
+        """Hot groups whose cache entry is missing or goes stale within `horizon` seconds."""
+        out = []
+        for key, group_input, score in self.top(n):
+            if group_cache.is_negative(key):
+                continue  # known not to resolve: don't spend a ResolveUsername on it
+            left = group_cache.expires_in(key)
+            if left is None or left < horizon:
+                out.append((key, group_input))
+        return out
+
+    async def _refresh(self, targets):
+        request_priority.set(PRIORITY_BACKGROUND)
+        try:
+            for key, group_input in targets:
+                if fetch_gate.waiting():
+                    self.counters["skipped_busy"] += 1
+                    break
+                try:
+                    await _fetch_and_store(group_input, key)
+                    self.counters["refreshed"] += 1
+                    metrics.inc("groupbot_hot_refresh_total", result="ok")
+                except Exception as e:
+                    self.counters["failed"] += 1
+                    metrics.inc("groupbot_hot_refresh_total", result="busy" if isinstance(e, Busy) else "error")
+                    logger.info("Hot refresh of %s failed: %s", group_input, e)
+        finally:
+            self._running = False
+
+    def run(self, budget, horizon):
+        """Start a refresh pass on the Telethon loop unless one is running or users are waiting."""
+        if self._running:
+            return 0
+        if fetch_gate.waiting() or fetch_gate.active >= max(1, fetch_gate.limit // 2):
+            self.counters["skipped_busy"] += 1
+            return 0
+        targets = self.due(HOT_TOP_N, horizon)[:budget]
+        if not targets:
+            return 0
+        self._running = True
+        self.counters["runs"] += 1
+        submit_tele(self._refresh(targets))
+        return len(targets)
+
+    def dump(self):
+        with self._lock:
+            return [[list(key), score, updated, inp] for key, (score, updated, inp) in self._scores.items()]
+
+    def restore(self, items):
+        for key, score, updated, group_input in items:
+            self.record(tuple(key), group_input, score, now=updated)
+        return len(items)
+
+    def stats(self):
+        with self._lock:
+            out = dict(self.counters)
+            out["tracked"] = len(self._scores)
+        return out
+
+
+hot_groups = HotGroups(HOT_HALF_LIFE, HOT_MAX_TRACKED)
+
+
+def hot_refresh_job(context: CallbackContext):
+    # refresh whatever goes stale before the pass after next
+    hot_groups.run(HOT_REFRESH_BUDGET, 2 * HOT_REFRESH_INTERVAL)
+
+
+# ---------------- Bulk lookups ----------------
+BULK_HEADER_NAMES = {"link", "links", "group", "groups", "username", "usernames", "id", "ids", "url", "chat"}
+BULK_FIELDS = [
+    "input", "status", "error", "group", "id", "type", "member_count",
+    "approx_date", "method", "owner", "admin_count", "admins", "note",
+]
+
+
+def parse_bulk_input(text):
+    """Group references from a text or CSV document: first column, header skipped."""
+    items = []
+    for i, row in enumerate(csv.reader(io.StringIO(text))):
+        cells = [c.strip() for c in row if c.strip()]
+        if not cells:
+            continue
+        if i == 0 and cells[0].lower() in BULK_HEADER_NAMES:
+            continue
+        # plain text lists may put several references on one line
+        items.extend(cells[0].split() if len(cells) == 1 else cells[:1])
+    return items
+
+
+def normalize_group_inputs(items):
+    """Classify and dedupe many references in one pass.
+
+    Returns (targets, invalid): targets is [(raw, GroupTarget, cache_key)]
+    for the distinct group references in input order, invalid the raw items
+    that are not one.
+    """
+    seen = set()
+    seen_raw = set()
+    targets = []
+    invalid = []
+    for raw in items:
+        # bulk lists repeat themselves: skip exact repeats before parsing
+        if raw in seen_raw:
+            continue
+        seen_raw.add(raw)
+        target = parse_group_input(raw)
+        if target is None:
+            invalid.append(raw)
+            continue
+        key = _cache_key(target_input(target))
+        if key in seen:
+            continue
+        seen.add(key)
+        targets.append((raw, target, key))
+    return targets, invalid
+
+
+class BulkResultWriter:
+    """Writes bulk results to `path` row by row as CSV or a JSON array."""
+
+    def __init__(self, path, fmt="csv"):
+        self.fmt = fmt
+        self.count = 0
+        self._f = open(path, "w", newline="", encoding="utf-8")
+        if fmt == "csv":
+            self._csv = csv.DictWriter(self._f, fieldnames=BULK_FIELDS)
+            self._csv.writeheader()
+        else:
+            self._f.write("[\n")
+
+    def write(self, raw, info=None, error=None):
+        row = {"input": raw, "status": "ok" if error is None else "error", "error": error or ""}
+        if info:
+            for field in BULK_FIELDS[3:]:
+                row[field] = info.get(field)
+            if self.fmt == "csv":
+                row["admins"] = "; ".join(info.get("admins") or [])
+        if self.fmt == "csv":
+            self._csv.writerow(row)
+        else:
+            self._f.write((",\n" if self.count else "") + json.dumps(row, ensure_ascii=False, default=str))
+        self.count += 1
+
+    def close(self):
+        if self.fmt != "csv":
+            self._f.write("\n]\n")
+        self._f.close()
+
+
+async def bulk_lookup(targets, writer, progress, concurrency=None, priority=PRIORITY_INLINE, user_id=None):
+    """Look up normalize_group_inputs() targets with bounded parallelism, writing each result as it lands.
+
+    `progress` is a dict updated in place ({"done", "failed", "total"}) so the
+    calling thread can report on it; returns the number of failures.
+    """
+    sem = asyncio.Semaphore(concurrency or BULK_CONCURRENCY)
+    progress.update(done=0, failed=0, total=len(targets))
+
+    async def lookup(raw):
+        # a bulk job has already been admitted: wait out short overloads
+        for attempt in range(BULK_BUSY_RETRIES):
+            try:
+                return await get_group_info_async(raw, priority)
+            except Busy:
+                await asyncio.sleep(2 ** attempt)
+        return await get_group_info_async(raw, priority)
+
+    async def one(raw):
+        hot_groups.record_input(raw)
+        async with sem:
+            try:
+                info = await lookup(raw)
+            except Exception as e:
+                writer.write(raw, error=str(e))
+                progress["failed"] += 1
+            else:
+                writer.write(raw, info)
+                if user_id is not None:
+                    record_lookup(user_id, raw, info)
+            progress["done"] += 1
+
+    await asyncio.gather(*(one(raw) for raw, _, _ in targets))
+    return progress["failed"]
+
+
+def bulkcheck_cli(argv):
+    """Offline entry point: python group.py bulkcheck INPUT [-o OUTPUT] [--format csv|json]"""
+    parser = argparse.ArgumentParser(prog="group.py bulkcheck", description="Look up many groups at once.")
+    parser.add_argument("input", help="text/CSV file with one link, @username or id per line ('-' for stdin)")
+    parser.add_argument("-o", "--output", help="output file (default: bulkcheck.<format>)")
+    parser.add_argument("--format", choices=("csv", "json"), default="csv")
+    parser.add_argument("--concurrency", type=int, default=BULK_CONCURRENCY)
+    args = parser.parse_args(argv)
+
+    init_db()
+    entity_store.prewarm(ENTITY_PREWARM_LIMIT)
+    date_estimator.load()
+    if args.input == "-":
+        text = sys.stdin.read()
+    else:
+        with open(args.input, encoding="utf-8") as f:
+            text = f.read()
+    targets, invalid = normalize_group_inputs(parse_bulk_input(text))
+    for raw in invalid:
+        print(f"skipping {raw!r}: not a group reference", file=sys.stderr)
+    output = args.output or f"bulkcheck.{args.format}"
+    writer = BulkResultWriter(output, args.format)
+    progress = {}
+    started = time.time()
+    fut = submit_tele(bulk_lookup(targets, writer, progress, args.concurrency, PRIORITY_CHECK))
+    try:
+        while True:
+            try:
+                failed = fut.result(BULK_PROGRESS_INTERVAL)
+                break
+            except concurrent.futures.TimeoutError:
+                print(f"{progress.get('done', 0)}/{len(targets)} done", file=sys.stderr)
+    finally:
+        writer.close()
+        stop_tele_loop()
+        stop_persist_writer()
+        flush_stats()
+        close_db()
+    print(
+        f"{len(targets)} groups ({failed} failed) in {time.time() - started:.1f}s -> {output}",
+        file=sys.stderr,
+    )
+    return 0
+
+
 # ---------------- Bot helpers ----------------
-def user_in_channel(bot, user_id):
+# Channel membership answers are cached per user: positive results for
+# MEMBERSHIP_TTL seconds, negative ones only briefly so a user who just
+# joined isn't kept out. verify_callback always asks Telegram.
+_membership = {}
+_membership_lock = threading.Lock()
+membership_counters = {"hits": 0, "misses": 0, "invalidations": 0}
+
+MEMBER_STATUSES = ("member", "administrator", "creator")
+
+
+def _remember_membership(user_id, is_member):
+    ttl = MEMBERSHIP_TTL if is_member else MEMBERSHIP_NEGATIVE_TTL
+    with _membership_lock:
+        _membership[user_id] = (is_member, time.time() + ttl)
+        if len(_membership) > MEMBERSHIP_MAX_ENTRIES:
+            now = time.time()
+            for uid in [uid for uid, (_, exp) in _membership.items() if exp <= now]:
+                del _membership[uid]
+
+
+def user_in_channel(bot, user_id, use_cache=True):
+    if use_cache:
+        with _membership_lock:
+            cached = _membership.get(user_id)
+            if cached and cached[1] > time.time():
+                membership_counters["hits"] += 1
+                return cached[0]
+            membership_counters["misses"] += 1
+    started = time.perf_counter()
     try:
         member = bot.get_chat_member(CHANNEL_USERNAME, user_id)
         status = getattr(member, "status", "")
-        if str(status).lower() in ("member", "administrator", "creator"):
-            return True
-        return False
+        is_member = str(status).lower() in MEMBER_STATUSES
     except Exception as e:
+        metrics.inc("groupbot_get_chat_member_errors_total")
         logger.info("get_chat_member failed: %s", e)
         return False
+    finally:
+        metrics.observe("groupbot_get_chat_member_seconds", time.perf_counter() - started)
+    _remember_membership(user_id, is_member)
+    return is_member
+
+
+def membership_update_handler(update: Update, context: CallbackContext):
+    """Keep the membership cache in sync from chat_member updates (bot must be channel admin)."""
+    cm = update.chat_member
+    if not cm or not cm.chat.username:
+        return
+    if cm.chat.username.lower() != CHANNEL_USERNAME.lstrip("@").lower():
+        return
+    status = str(cm.new_chat_member.status).lower()
+    _remember_membership(cm.new_chat_member.user.id, status in MEMBER_STATUSES)
+    with _membership_lock:
+        membership_counters["invalidations"] += 1
+
+
+def membership_stats():
+    with _membership_lock:
+        out = dict(membership_counters)
+        out["entries"] = len(_membership)
+    return out
+
+
+def admit_lookup(user_id, group_input=None, force=False):
+    """None if the user's lookup may go ahead, else the reason to show instead.
+
+    Checked before any credits are charged. Cached groups are still served
+    while fetches are being shed or Telethon failed to start; group_input=None
+    means a fetch is certain.
+    """
+    wait = user_limiter.take(user_id)
+    if wait:
+        metrics.inc("groupbot_admission_rejected_total", reason="user_rate")
+        return f"Too many requests, try again in {int(wait) + 1}s."
+    if tele_startup_error is not None:
+        reason, error = "telethon_failed", TeleUnavailable()
+    elif fetch_gate.overloaded():
+        reason, error = "overloaded", Busy()
+    else:
+        return None
+    inp = normalize_group_input(group_input) if group_input is not None else None
+    if force or inp is None or not group_cache.contains(_cache_key(inp)):
+        metrics.inc("groupbot_admission_rejected_total", reason=reason)
+        return str(error) + "."
+    return None
 
 
 def format_info_text(info: dict):
-    admins = ", ".join(info.get("admins") or []) or "None"
+    names = info.get("admins") or []
+    admins = ", ".join(names) or "None"
+    count = info.get("admin_count") or len(names)
+    if count > len(names):
+        admins += f" … and {count - len(names)} more"
     text = (
         f"<b>Title:</b> {escape(info.get('group') or 'Unknown')}\n"
         f"<b>ID:</b> <code>{info.get('id')}</code>\n"
@@ -383,10 +2547,13 @@ def format_info_text(info: dict):
         f"<b>Members:</b> {info.get('member_count') or 'Unknown'}\n"
         f"<b>Created (approx):</b> {escape(info.get('approx_date') or 'Unknown')} ({escape(info.get('method') or '')})\n"
         f"<b>Owner (best-effort):</b> {escape(info.get('owner') or 'Unknown')}\n"
-        f"<b>Admins:</b> {escape(admins)}\n"
+        f"<b>Admins ({count}):</b> {escape(admins)}\n"
     )
     if info.get("note"):
         text += f"\n<i>{escape(info.get('note'))}</i>\n"
+    as_of = info.get("as_of")
+    if as_of and time.time() - as_of > 60:
+        text += f"\n<i>As of {datetime.utcfromtimestamp(as_of).strftime('%Y-%m-%d %H:%M')} UTC</i>\n"
     return text
 
 
@@ -428,7 +2595,7 @@ def verify_callback(update: Update, context: CallbackContext):
     query = update.callback_query
     user = query.from_user
     query.answer()
-    if user_in_channel(context.bot, user.id):
+    if user_in_channel(context.bot, user.id, use_cache=False):
         create_user_if_missing(user.id, user.username or "", user.first_name or "")
         query.message.reply_text("✅ Verified! You can now use inline queries or /check <group_link>.")
     else:
@@ -441,7 +2608,7 @@ def check_handler(update: Update, context: CallbackContext):
     create_user_if_missing(user.id, user.username or "", user.first_name or "")
 
     if len(context.args) == 0:
-        update.message.reply_text("Usage: /check <group_link_or_username_or_id>")
+        update.message.reply_text("Usage: /check <group_link_or_username_or_id> [refresh]")
         return
 
     if not user_in_channel(context.bot, user.id):
@@ -449,26 +2616,165 @@ def check_handler(update: Update, context: CallbackContext):
         update.message.reply_text(f"❌ You must join {CHANNEL_USERNAME} first.", reply_markup=kb)
         return
 
+    query_text = context.args[0]
+    force = len(context.args) > 1 and context.args[1].lower() in ("refresh", "fresh", "-f")
+    busy = admit_lookup(user.id, query_text, force)
+    if busy:
+        update.message.reply_text(f"⏳ {busy} No credits were charged.")
+        return
+
     ok, err = try_consume_credits(user.id, COST_PER_SEARCH)
     if not ok:
         update.message.reply_text(err + f"\nContact admin to add credits → @{ADMIN_USERNAME}")
         return
 
-    query_text = context.args[0]
+    increment_stat("check_searches")
+    hot_groups.record_input(query_text)
     update.message.reply_text("🔍 Fetching group info... please wait a few seconds.")
     try:
-        info = fetch_group_info(query_text)
+        info = get_group_info(query_text, force=force)
+        record_lookup(user.id, query_text, info)
         update.message.reply_text(format_info_text(info), parse_mode=ParseMode.HTML)
     except Exception as e:
         refund_credits(user.id, COST_PER_SEARCH)
+        increment_stat("refunds")
         update.message.reply_text(f"⚠️ Error fetching info: {e}\nYour credit has been refunded.")
 
 
+def bulkcheck_handler(update: Update, context: CallbackContext):
+    """/bulkcheck [json] <links...>, or sent as the caption of / a reply to a .txt/.csv document."""
+    user = update.effective_user
+    msg = update.effective_message
+    create_user_if_missing(user.id, user.username or "", user.first_name or "")
+
+    if not user_in_channel(context.bot, user.id):
+        kb = InlineKeyboardMarkup([[InlineKeyboardButton("Verify Join", callback_data="verify_join")]])
+        msg.reply_text(f"❌ You must join {CHANNEL_USERNAME} first.", reply_markup=kb)
+        return
+
+    # command text (or caption) after "/bulkcheck", optional format word first
+    command_text = (msg.text or msg.caption or "").split(None, 1)
+    rest = command_text[1] if len(command_text) > 1 else ""
+    fmt = "csv"
+    first = rest.split(None, 1)
+    if first and first[0].lower() in ("csv", "json"):
+        fmt = first[0].lower()
+        rest = first[1] if len(first) > 1 else ""
+
+    document = msg.document or (msg.reply_to_message.document if msg.reply_to_message else None)
+    if document:
+        if document.file_size and document.file_size > BULK_MAX_FILE_BYTES:
+            msg.reply_text(f"File too large (max {BULK_MAX_FILE_BYTES // 1024} KB).")
+            return
+        data = context.bot.get_file(document.file_id).download_as_bytearray()
+        rest += "\n" + bytes(data).decode("utf-8", errors="replace")
+
+    targets, invalid = normalize_group_inputs(parse_bulk_input(rest))
+    if not targets:
+        msg.reply_text(
+            "Usage: /bulkcheck [csv|json] <link1> <link2> ...\n"
+            "or send a .txt/.csv file with /bulkcheck as caption (or reply /bulkcheck to it)."
+        )
+        return
+    if len(targets) > BULK_MAX_ITEMS:
+        msg.reply_text(f"Too many groups ({len(targets)}); the limit is {BULK_MAX_ITEMS} per request.")
+        return
+    busy = admit_lookup(user.id)
+    if busy:
+        msg.reply_text(f"⏳ {busy} No credits were charged.")
+        return
+
+    total_cost = COST_PER_SEARCH * len(targets)
+    ok, balance = debit_credits(user.id, total_cost, stat_key=None)
+    if not ok:
+        msg.reply_text(
+            f"{len(targets)} groups cost {total_cost} credits, you have {balance}.\n"
+            f"Contact admin to add credits → @{ADMIN_USERNAME}"
+        )
+        return
+    increment_stat("total_searches", len(targets))
+    increment_stat("bulk_searches", len(targets))
+
+    skipped = f" (skipped {len(invalid)} entries that are not group references)" if invalid else ""
+    status = msg.reply_text(f"🔍 Looking up {len(targets)} groups...{skipped}")
+    fd, path = tempfile.mkstemp(prefix="bulkcheck-", suffix="." + fmt)
+    os.close(fd)
+    writer = BulkResultWriter(path, fmt)
+    progress = {}
+    fut = submit_tele(bulk_lookup(targets, writer, progress, user_id=user.id))
+    try:
+        last_done = -1
+        while True:
+            try:
+                failed = fut.result(BULK_PROGRESS_INTERVAL)
+                break
+            except concurrent.futures.TimeoutError:
+                done = progress.get("done", 0)
+                if done != last_done:
+                    last_done = done
+                    try:
+                        status.edit_text(f"🔍 Looking up {len(targets)} groups... {done}/{len(targets)} done")
+                    except Exception as e:
+                        logger.debug("progress edit failed: %s", e)
+    except Exception as e:
+        writer.close()
+        os.remove(path)
+        refund_credits(user.id, total_cost)
+        increment_stat("refunds")
+        msg.reply_text(f"⚠️ Bulk lookup failed: {e}\nYour credits have been refunded.")
+        return
+    writer.close()
+
+    refunded = ""
+    if failed:
+        refund_credits(user.id, COST_PER_SEARCH * failed)
+        increment_stat("refunds", failed)
+        refunded = f", {COST_PER_SEARCH * failed} credits refunded"
+    try:
+        with open(path, "rb") as f:
+            msg.reply_document(
+                f,
+                filename=f"bulkcheck.{fmt}",
+                caption=f"✅ {len(targets) - failed}/{len(targets)} groups resolved ({failed} failed{refunded}).",
+            )
+    finally:
+        os.remove(path)
+
+
+# Inline mode: Telegram sends an update per keystroke, so each user's queries
+# are debounced (only the latest one after INLINE_DEBOUNCE seconds is looked
+# up; cached groups are answered at once) and a newer query cancels the
+# user's in-flight lookup. _inline_state only holds users with a query in
+# progress. Nothing is charged until a result is actually sent
+# (chosen_inline_result; requires inline feedback enabled via @BotFather
+# /setinlinefeedback).
+_inline_state = {}
+_inline_lock = threading.Lock()
+
+
+def _inline_article(result_id, title, text, description, parse_mode=None):
+    return InlineQueryResultArticle(
+        id=result_id,
+        title=title,
+        input_message_content=InputTextMessageContent(text, parse_mode=parse_mode),
+        description=description,
+    )
+
+
+def _inline_info_result(info):
+    return _inline_article(
+        "info:" + str(info.get("id")),
+        f"{info.get('group')} — {info.get('approx_date')}",
+        format_info_text(info),
+        f"Created: {info.get('approx_date')} · costs {COST_PER_SEARCH} credits when sent",
+        parse_mode="HTML",
+    )
+
+
 def inline_query_handler(update: Update, context: CallbackContext):
     inline_q = update.inline_query
     user = inline_q.from_user
     query_text = inline_q.query.strip()
-    create_user_if_missing(user.id, user.username or "", user.first_name or "")
 
     if not query_text:
         hint = "Type a group link or username: @groupname or https://t.me/groupname"
@@ -481,6 +2787,53 @@ def inline_query_handler(update: Update, context: CallbackContext):
         update.inline_query.answer([res], cache_time=10)
         return
 
+    # debounce: a newer query supersedes this one (and cancels its lookup);
+    # the lookup starts once the user has been quiet for INLINE_DEBOUNCE
+    with _inline_lock:
+        seq, prev_fut = _inline_state.get(user.id, (0, None))
+        seq += 1
+        _inline_state[user.id] = (seq, None)
+    if prev_fut is not None:
+        prev_fut.cancel()
+    inp = normalize_group_input(query_text)
+    if inp is not None and group_cache.contains(_cache_key(inp)):
+        # nothing to fetch: a cached answer costs nothing, so skip the wait
+        _inline_lookup(update, context, seq)
+        return
+    # a timer on the Telethon loop, so no worker thread sleeps through the wait
+    start_tele_loop()
+    tele_loop.call_soon_threadsafe(tele_loop.call_later, INLINE_DEBOUNCE, _inline_debounced, update, context, seq)
+
+
+def _inline_debounced(update, context, seq):
+    """Called on the Telethon loop when the quiet period ends: hand the lookup to a PTB worker."""
+    with _inline_lock:
+        if _inline_state.get(update.inline_query.from_user.id, (0, None))[0] != seq:
+            return
+    context.dispatcher.run_async(track_inflight(_inline_lookup), update, context, seq, update=update)
+
+
+def _inline_lookup(update: Update, context: CallbackContext, seq):
+    user = update.inline_query.from_user
+    try:
+        _inline_answer(update, context, seq)
+    finally:
+        # every exit: _inline_state only holds users with a query in progress
+        with _inline_lock:
+            if _inline_state.get(user.id, (0, None))[0] == seq:
+                del _inline_state[user.id]
+
+
+def _inline_answer(update: Update, context: CallbackContext, seq):
+    inline_q = update.inline_query
+    user = inline_q.from_user
+    query_text = inline_q.query.strip()
+    with _inline_lock:
+        if _inline_state.get(user.id, (0, None))[0] != seq:
+            return
+
+    record = create_user_if_missing(user.id, user.username or "", user.first_name or "")
+
     if not user_in_channel(context.bot, user.id):
         join_msg = f"You must join {CHANNEL_USERNAME} to use this bot. Open bot chat to verify."
         res = InlineQueryResultArticle(
@@ -492,38 +2845,65 @@ def inline_query_handler(update: Update, context: CallbackContext):
         update.inline_query.answer([res], cache_time=5, switch_pm_text=f"Join {CHANNEL_USERNAME} to use", switch_pm_parameter="verify")
         return
 
-    ok, err = try_consume_credits(user.id, COST_PER_SEARCH)
-    if not ok:
-        no_credits_text = err + f"\nContact admin to add credits → @{ADMIN_USERNAME}"
+    if record["credits"] < COST_PER_SEARCH:
+        no_credits_text = f"Not enough credits. You have {record['credits']} credits.\nContact admin to add credits → @{ADMIN_USERNAME}"
         res = InlineQueryResultArticle(
             id="no_credits",
             title="No credits",
             input_message_content=InputTextMessageContent(no_credits_text),
             description="You don't have enough credits.",
         )
-        update.inline_query.answer([res], cache_time=5)
+        update.inline_query.answer([res], cache_time=5, is_personal=True)
         return
 
+    hot_groups.record_input(query_text)
+    # cached preview: answer straight away, stale entries refresh in the background
+    state, info = cached_group_info(query_text)
+    if state is not None:
+        update.inline_query.answer([_inline_info_result(info)], cache_time=5, is_personal=True)
+        return
+
+    busy = admit_lookup(user.id, query_text)
+    if busy:
+        res = _inline_article("busy", "Busy", f"{busy} (no credits charged)", busy)
+        update.inline_query.answer([res], cache_time=1, is_personal=True)
+        return
+
+    fut = submit_tele(get_group_info_async(query_text, PRIORITY_INLINE))
+    with _inline_lock:
+        if _inline_state.get(user.id, (0, None))[0] != seq:
+            fut.cancel()
+            return
+        _inline_state[user.id] = (seq, fut)
     try:
-        info = fetch_group_info(query_text)
-        text = format_info_text(info)
-        res = InlineQueryResultArticle(
-            id="res_" + str(int(time.time())),
-            title=f"{info.get('group')} — {info.get('approx_date')}",
-            input_message_content=InputTextMessageContent(text, parse_mode="HTML"),
-            description=f"Created: {info.get('approx_date')}",
-        )
-        update.inline_query.answer([res], cache_time=5)
+        info = fut.result(INLINE_ANSWER_TIMEOUT)
+        res = _inline_info_result(info)
+    except concurrent.futures.CancelledError:
+        return
+    except concurrent.futures.TimeoutError:
+        # keep the lookup running; it lands in the cache for the next update
+        res = _inline_article("pending", "Still looking up…", "Group lookup still in progress, try again.", "Keep typing or retry in a moment.")
+        update.inline_query.answer([res], cache_time=1, is_personal=True)
+        return
     except Exception as e:
-        refund_credits(user.id, COST_PER_SEARCH)
-        err_text = f"Error fetching info: {str(e)} (credits refunded)"
-        res = InlineQueryResultArticle(
-            id="err",
-            title="Error",
-            input_message_content=InputTextMessageContent(err_text),
-            description="Could not fetch group info.",
-        )
-        update.inline_query.answer([res], cache_time=5)
+        err_text = f"Error fetching info: {str(e)} (no credits charged)"
+        res = _inline_article("err", "Error", err_text, "Could not fetch group info.")
+    update.inline_query.answer([res], cache_time=5, is_personal=True)
+
+
+def chosen_inline_result_handler(update: Update, context: CallbackContext):
+    chosen = update.chosen_inline_result
+    if not chosen.result_id.startswith("info:"):
+        return
+    user = chosen.from_user
+    ok, balance = debit_credits(user.id, COST_PER_SEARCH)
+    if ok:
+        increment_stat("inline_searches")
+        state, info = cached_group_info(chosen.query)
+        if info:
+            record_lookup(user.id, chosen.query, info)
+    else:
+        logger.info("Inline result sent by %s without enough credits (balance %s)", user.id, balance)
 
 
 # Admin commands
@@ -544,11 +2924,7 @@ def addcredit_command(update: Update, context: CallbackContext):
 
     if target.startswith("@"):
         uname = target[1:]
-        conn = sqlite3.connect(DATABASE)
-        cur = conn.cursor()
-        cur.execute("SELECT user_id FROM users WHERE username=?", (uname,))
-        row = cur.fetchone()
-        conn.close()
+        row = find_user_by_username(uname)
         if row:
             tid = row[0]
             add_credits_to_user_id(tid, amount)
@@ -593,11 +2969,7 @@ def usercredits_command(update: Update, context: CallbackContext):
     target = context.args[0]
     if target.startswith("@"):
         uname = target[1:]
-        conn = sqlite3.connect(DATABASE)
-        cur = conn.cursor()
-        cur.execute("SELECT user_id, credits FROM users WHERE username=?", (uname,))
-        row = cur.fetchone()
-        conn.close()
+        row = find_user_by_username(uname)
         if not row:
             update.message.reply_text("User not found.")
             return
@@ -614,66 +2986,508 @@ def usercredits_command(update: Update, context: CallbackContext):
             update.message_reply_text("Invalid id.")
 
 
+def history_command(update: Update, context: CallbackContext):
+    """Show the user's recent lookups"""
+    user = update.effective_user
+    rows = get_user_history(user.id)
+    if not rows:
+        update.message.reply_text("No lookups yet. Try /check <group_link>.")
+        return
+    lines = ["<b>Your recent lookups:</b>"]
+    for group_key, group_id, title, ts in rows:
+        when = datetime.utcfromtimestamp(ts).strftime("%Y-%m-%d %H:%M")
+        lines.append(f"{when} — {escape(title or group_key)} (<code>{group_id}</code>)")
+    update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+
+
+def topgroups_command(update: Update, context: CallbackContext):
+    user = update.effective_user
+    if user.username != ADMIN_USERNAME:
+        update.message.reply_text("Not authorized.")
+        return
+    try:
+        days = int(context.args[0]) if context.args else 7
+    except ValueError:
+        update.message.reply_text("Usage: /topgroups [days]")
+        return
+    rows = get_top_groups(int(time.time()) - days * 86400)
+    if not rows:
+        update.message.reply_text(f"No lookups in the last {days} days.")
+        return
+    lines = [f"<b>Most looked-up groups ({days}d):</b>"]
+    for i, (title, group_id, n) in enumerate(rows, 1):
+        lines.append(f"{i}. {escape(str(title))} (<code>{group_id}</code>) — {n}")
+    update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+
+
 def stats_command(update: Update, context: CallbackContext):
     user = update.effective_user
     if user.username != ADMIN_USERNAME:
-        update.message_reply_text("Not authorized.")
+        update.message.reply_text("Not authorized.")
         return
-    conn = sqlite3.connect(DATABASE)
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) FROM users")
-    total_users = cur.fetchone()[0]
-    conn.close()
+    total_users = count_users()
     total_searches = get_stat("total_searches")
-    update.message.reply_text(f"Users: {total_users}\nTotal searches: {total_searches}")
+    lines = [
+        f"Users: {total_users}",
+        f"Total searches: {total_searches}",
+        f"/check: {get_stat('check_searches')}, inline: {get_stat('inline_searches')}, refunds: {get_stat('refunds')}",
+        "",
+    ]
+
+    cs = group_cache.stats()
+    lookups = cs["hits"] + cs["stale_hits"] + cs["misses"] + cs["negative_hits"]
+    hit_ratio = (lookups - cs["misses"]) / lookups * 100 if lookups else 0.0
+    lines += [
+        f"Group cache: {cs['entries']} entries, {hit_ratio:.1f}% hit ratio",
+        f"Hits: {cs['hits']} (stale {cs['stale_hits']}, negative {cs['negative_hits']}, from disk {cs['disk_hits']})",
+        f"Misses: {cs['misses']}",
+        f"Evictions: {cs['evictions']}",
+        f"Background refreshes: {cs['refreshes']}",
+        f"Telegram fetches: {coalesce_counters['fetches']}, coalesced requests: {coalesce_counters['coalesced']}",
+        "",
+    ]
+
+    ms = membership_stats()
+    checks = ms["hits"] + ms["misses"]
+    member_ratio = ms["hits"] / checks * 100 if checks else 0.0
+    lines += [
+        f"Membership cache: {ms['entries']} users, {member_ratio:.1f}% hit ratio",
+        f"get_chat_member calls avoided: {ms['hits']} (misses {ms['misses']}, updates {ms['invalidations']})",
+        "",
+    ]
+
+    lines.append("Scheduler (calls / queued / avg wait / max wait / FloodWaits):")
+    for name, st in scheduler_stats().items():
+        avg_wait = st["wait_total"] / st["calls"] if st["calls"] else 0.0
+        line = f"{name}: {st['calls']} / {st['queued']} / {avg_wait:.2f}s / {st['wait_max']:.2f}s / {st['flood_waits']}"
+        if st["blocked_for"] > 0:
+            line += f" (paused {st['blocked_for']:.0f}s)"
+        lines.append(line)
+
+    gate = fetch_gate.stats()
+    rejected = metrics.counter_values("groupbot_admission_rejected_total")
+    queued = sum(metrics.counter_values("groupbot_admission_queued_total").values())
+    lines += [
+        "",
+        f"Admission: {gate['active']}/{FETCH_CONCURRENCY} fetching, {gate['waiting']} waiting (~{gate['expected_wait']:.1f}s), {queued} queued so far",
+        "Rejected: " + (", ".join(f"{dict(k)['reason']} {v}" for k, v in sorted(rejected.items())) or "none"),
+    ]
+
+    hot = hot_groups.stats()
+    lines.append(
+        f"Hot refresher: {hot['tracked']} tracked, {hot['refreshed']} refreshed / {hot['failed']} failed"
+        f" in {hot['runs']} runs, {hot['skipped_busy']} skipped while busy"
+    )
+
+    lines += ["", "Latency (count / avg / p95):"]
+    for title, name, label in (
+        ("handler", "groupbot_handler_seconds", "handler"),
+        ("stage", "groupbot_fetch_stage_seconds", "stage"),
+    ):
+        for labels, (count, avg, p95) in sorted(metrics.summary(name).items()):
+            lines.append(f"{title} {dict(labels).get(label)}: {count} / {avg * 1000:.0f}ms / ≤{p95 * 1000:.0f}ms")
+    db = metrics.summary("groupbot_db_seconds")
+    if db:
+        calls = sum(c for c, _, _ in db.values())
+        avg = sum(c * a for c, a, _ in db.values()) / calls
+        lines.append(f"db: {calls} calls / {avg * 1000:.2f}ms avg")
+
+    es = entity_store.stats()
+    resolves = es["hits"] + es["misses"] + es["expired"]
+    lines += [
+        "",
+        f"Entity store: {es['entries']} keys, {es['hits'] / resolves * 100 if resolves else 0.0:.1f}% hit ratio",
+        f"ResolveUsername avoided: {es['hits']} (misses {es['misses']}, expired {es['expired']}, invalid {es['invalid']})",
+    ]
+
+    ds = date_estimator.stats()
+    lines.append(
+        f"Date table: {ds['points']} points, {ds['confident']} confident / {ds['unconfident']} rough estimates"
+    )
+
+    if len(tele_sessions) > 1:
+        lines += ["", "Sessions (in flight / fetches / errors / FloodWaits):"]
+        for index, st in session_stats():
+            line = f"#{index}: {st['load']} / {st['fetches']} / {st['errors']} / {st['flood_waits']}"
+            if st["benched_for"] > 0:
+                line += f" (benched {st['benched_for']:.0f}s)"
+            lines.append(line)
+
+    update.message.reply_text("\n".join(lines))
 
 
 def export_users_command(update: Update, context: CallbackContext):
+    """/export_users [csv|jsonl] [gz] [since=YYYY-MM-DD] [min_credits=N]"""
     user = update.effective_user
     if user.username != ADMIN_USERNAME:
-        update.message_reply_text("Not authorized.")
+        update.message.reply_text("Not authorized.")
+        return
+    fmt, compress, created_after, min_credits = "csv", False, None, None
+    try:
+        for arg in context.args:
+            arg = arg.lower()
+            if arg in ("csv", "jsonl"):
+                fmt = arg
+            elif arg in ("gz", "gzip"):
+                compress = True
+            elif arg.startswith("since="):
+                created_after = int(datetime.strptime(arg[6:], "%Y-%m-%d").timestamp())
+            elif arg.startswith("min_credits="):
+                min_credits = int(arg[12:])
+            else:
+                raise ValueError(arg)
+    except ValueError:
+        update.message.reply_text("Usage: /export_users [csv|jsonl] [gz] [since=YYYY-MM-DD] [min_credits=N]")
         return
-    rows = get_all_users()
-    fname = "users_export.csv"
-    with open(fname, "w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerow(["user_id", "username", "first_name", "credits", "created_at"])
-        for r in rows:
-            writer.writerow(r)
-    update.message_reply_text(f"✅ Exported {len(rows)} users to {fname}")
+
+    filename = f"users_export.{fmt}" + (".gz" if compress else "")
+    fd, path = tempfile.mkstemp(prefix="users-export-", suffix="." + fmt)
+    os.close(fd)
+    started = time.time()
+    count = 0
+    try:
+        opener = gzip.open if compress else open
+        with opener(path, "wt", newline="", encoding="utf-8") as f:
+            if fmt == "csv":
+                writer = csv.writer(f)
+                writer.writerow(USER_EXPORT_FIELDS)
+            for r in iter_users(created_after, min_credits):
+                if fmt == "csv":
+                    writer.writerow(r)
+                else:
+                    f.write(json.dumps(dict(zip(USER_EXPORT_FIELDS, r)), ensure_ascii=False) + "\n")
+                count += 1
+        elapsed = time.time() - started
+        logger.info("Exported %s users in %.2fs (%.0f rows/s)", count, elapsed, count / elapsed if elapsed else 0)
+        with open(path, "rb") as f:
+            update.message.reply_document(f, filename=filename, caption=f"✅ Exported {count} users")
+    finally:
+        os.remove(path)
 
 
 def error_handler(update: object, context: CallbackContext):
     logger.error(msg="Exception while handling an update:", exc_info=context.error)
 
 
+# ---------------- HTTP server (webhook, health, metrics) ----------------
+# In webhook mode Telegram POSTs updates to WEBHOOK_PATH; /healthz and
+# /metrics are served by the same small threaded server, which also runs in
+# polling mode when PORT is set (Render health checks).
+_inflight_requests = 0
+_inflight_lock = threading.Lock()
+_accepting_updates = threading.Event()
+_first_request_done = threading.Event()
+
+
+def track_inflight(callback):
+    """Wrap a handler so graceful shutdown can wait for it, recording its latency and errors."""
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    def wrapper(update, context, *args):
+        global _inflight_requests
+        with _inflight_lock:
+            _inflight_requests += 1
+        metrics.gauge_add("groupbot_handler_inflight", 1, handler=name)
+        started = time.perf_counter()
+        try:
+            return callback(update, context, *args)
+        except Exception:
+            metrics.inc("groupbot_handler_errors_total", handler=name)
+            raise
+        finally:
+            if not _first_request_done.is_set():
+                _first_request_done.set()
+                since_start = time.perf_counter() - _process_started
+                metrics.gauge_add("groupbot_first_request_seconds", since_start)
+                logger.info("First request handled %.2fs after process start", since_start)
+            metrics.observe("groupbot_handler_seconds", time.perf_counter() - started, handler=name)
+            metrics.gauge_add("groupbot_handler_inflight", -1, handler=name)
+            with _inflight_lock:
+                _inflight_requests -= 1
+
+    return wrapper
+
+
+def wait_for_drain(timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with _inflight_lock:
+            if _inflight_requests == 0:
+                return True
+        time.sleep(0.2)
+    logger.warning("Shutdown: %s requests still in flight after %ss", _inflight_requests, timeout)
+    return False
+
+
+def render_metrics():
+    """Metrics in Prometheus text format, plus the cache/scheduler counters as gauges."""
+    extra = [
+        (("groupbot_inflight_requests", ()), _inflight_requests),
+        (("groupbot_telethon_connected", ()), int(tele_connected.is_set())),
+    ]
+    for name, value in group_cache.stats().items():
+        extra.append((("groupbot_group_cache", (("counter", name),)), value))
+    for name, value in membership_stats().items():
+        extra.append((("groupbot_membership_cache", (("counter", name),)), value))
+    for name, value in entity_store.stats().items():
+        extra.append((("groupbot_entity_store", (("counter", name),)), value))
+    for name, value in coalesce_counters.items():
+        extra.append((("groupbot_coalesce", (("counter", name),)), value))
+    for method, st in scheduler_stats().items():
+        for name in ("calls", "queued", "wait_total", "flood_waits"):
+            extra.append((("groupbot_scheduler", (("counter", name), ("method", method))), st[name]))
+    for index, st in session_stats():
+        extra.append((("groupbot_session_load", (("session", index),)), st["load"]))
+    for name, value in fetch_gate.stats().items():
+        extra.append((("groupbot_fetch_gate", (("counter", name),)), value))
+    for name, value in hot_groups.stats().items():
+        extra.append((("groupbot_hot_groups", (("counter", name),)), value))
+    return metrics.render(extra)
+
+
+class BotHTTPHandler(BaseHTTPRequestHandler):
+    dispatcher = None
+    webhook_path = None
+
+    def _reply(self, code, body, content_type="text/plain; charset=utf-8"):
+        data = body.encode()
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/healthz":
+            status = {
+                "status": "ok" if tele_startup_error is None else "telethon_failed",
+                "telethon": all(sess.connected() for sess in tele_sessions),
+                "inflight": _inflight_requests,
+            }
+            self._reply(200 if tele_startup_error is None else 503, json.dumps(status), "application/json")
+        elif self.path == "/metrics":
+            self._reply(200, render_metrics(), "text/plain; version=0.0.4")
+        else:
+            self._reply(404, "not found")
+
+    def do_POST(self):
+        if self.webhook_path is None or self.path != self.webhook_path:
+            self._reply(404, "not found")
+            return
+        if not _accepting_updates.is_set():
+            # shutting down: Telegram retries the update later
+            self._reply(503, "draining")
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            payload = json.loads(self.rfile.read(length))
+            update = Update.de_json(payload, self.dispatcher.bot)
+        except (ValueError, TypeError) as e:
+            logger.warning("Bad webhook payload: %s", e)
+            self._reply(400, "bad request")
+            return
+        self.dispatcher.update_queue.put(update)
+        self._reply(200, "ok")
+
+    def log_message(self, format, *args):
+        logger.debug("http: " + format, *args)
+
+
+def start_http_server(dispatcher, webhook_path=None):
+    BotHTTPHandler.dispatcher = dispatcher
+    BotHTTPHandler.webhook_path = webhook_path
+    server = ThreadingHTTPServer(("0.0.0.0", PORT), BotHTTPHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="http-server", daemon=True).start()
+    logger.info("HTTP server listening on :%s", PORT)
+    return server
+
+
+# ---------------- Warm restart snapshot ----------------
+# The in-memory caches (group results with their fetch times, channel
+# membership, hot group scores) are written to SNAPSHOT_PATH at graceful
+# shutdown and read back on start, so a redeploy doesn't begin cold. Stored
+# entities and group results are in SQLite already; the snapshot covers what
+# only lived in memory. Entries keep their timestamps and expire as usual.
+def save_snapshot(path=None):
+    """Write the caches to the snapshot file (atomically); returns the number of entries."""
+    path = path or SNAPSHOT_PATH
+    now = time.time()
+    with _membership_lock:
+        membership = [[uid, member, expires] for uid, (member, expires) in _membership.items() if expires > now]
+    data = {
+        "version": 1,
+        "saved_at": now,
+        "group_cache": group_cache.dump(),
+        "membership": membership,
+        "hot_groups": hot_groups.dump(),
+    }
+    tmp = path + ".tmp"
+    with gzip.open(tmp, "wt", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+    return len(data["group_cache"]) + len(membership) + len(data["hot_groups"])
+
+
+def load_snapshot(path=None):
+    """Restore the caches from the snapshot file; returns {cache: entries restored}."""
+    path = path or SNAPSHOT_PATH
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable snapshot %s: %s", path, e)
+        return {}
+    if data.get("version") != 1 or time.time() - data.get("saved_at", 0) > SNAPSHOT_MAX_AGE:
+        return {}
+    now = time.time()
+    with _membership_lock:
+        membership = 0
+        for uid, member, expires in data["membership"]:
+            if expires > now and uid not in _membership:
+                _membership[uid] = (member, expires)
+                membership += 1
+    return {
+        "groups": group_cache.restore(data["group_cache"]),
+        "membership": membership,
+        "hot": hot_groups.restore(data["hot_groups"]),
+    }
+
+
 # ---------------- Main ----------------
 def main():
+    if not BOT_TOKEN:
+        raise RuntimeError("BOT_TOKEN env var is required")
+    phases = []
+    mark = time.perf_counter()
+
+    def phase(name):
+        nonlocal mark
+        now = time.perf_counter()
+        phases.append((name, now - mark))
+        mark = now
+
+    phases.append(("imports", mark - _process_started))
     init_db()
-    try:
-        if not tele_client.is_connected():
-            tele_client.connect()
-    except Exception as e:
-        logger.warning("Telethon connect warning: %s", e)
+    phase("init_db")
+    # Telethon imports and connects in the background; updates are served meanwhile
+    connector = submit_tele(connect_with_backoff())
+    phase("telethon")
+    restored = load_snapshot() if SNAPSHOT_PATH else {}
+    phase("snapshot")
+    entities = entity_store.prewarm(ENTITY_PREWARM_LIMIT)
+    phase("entities")
+    dates = date_estimator.load()
+    phase("dates")
+    if not restored.get("hot"):
+        hot_groups.load()
+    phase("hot_groups")
+    logger.info(
+        "Restored %s cached groups, %s memberships, %s hot groups, %s stored entities, %s date points",
+        restored.get("groups", 0),
+        restored.get("membership", 0),
+        hot_groups.stats()["tracked"],
+        entities,
+        dates,
+    )
 
-    updater = Updater(BOT_TOKEN, use_context=True)
+    updater = Updater(BOT_TOKEN, use_context=True, workers=BOT_WORKERS)
     dp = updater.dispatcher
 
     dp.add_handler(CommandHandler("start", start_handler))
-    dp.add_handler(CallbackQueryHandler(verify_callback, pattern="^verify_join$"))
-    dp.add_handler(CommandHandler("check", check_handler, pass_args=True))
+    dp.add_handler(CallbackQueryHandler(track_inflight(verify_callback), pattern="^verify_join$"))
+    dp.add_handler(CommandHandler("check", track_inflight(check_handler), pass_args=True, run_async=True))
+    dp.add_handler(CommandHandler("bulkcheck", track_inflight(bulkcheck_handler), run_async=True))
+    dp.add_handler(
+        MessageHandler(Filters.document & Filters.caption_regex(r"^/bulkcheck"), track_inflight(bulkcheck_handler), run_async=True)
+    )
     dp.add_handler(CommandHandler("balance", balance_command))  # ✅ added
-    dp.add_handler(InlineQueryHandler(inline_query_handler))
+    dp.add_handler(InlineQueryHandler(track_inflight(inline_query_handler), run_async=True))
+    dp.add_handler(ChosenInlineResultHandler(track_inflight(chosen_inline_result_handler)))
     dp.add_handler(CommandHandler("addcredit", addcredit_command, pass_args=True))
     dp.add_handler(CommandHandler("usercredits", usercredits_command, pass_args=True))
     dp.add_handler(CommandHandler("stats", stats_command))
-    dp.add_handler(CommandHandler("export_users", export_users_command))
+    dp.add_handler(CommandHandler("history", history_command))
+    dp.add_handler(CommandHandler("topgroups", topgroups_command, pass_args=True))
+    dp.add_handler(CommandHandler("export_users", export_users_command, pass_args=True, run_async=True))
+    if MEMBERSHIP_UPDATES:
+        dp.add_handler(ChatMemberHandler(membership_update_handler, ChatMemberHandler.CHAT_MEMBER))
     dp.add_error_handler(error_handler)
 
-    logger.info("Bot starting (polling)...")
-    updater.start_polling()
-    updater.idle()
+    updater.job_queue.run_repeating(flush_stats_job, interval=STATS_FLUSH_INTERVAL, first=STATS_FLUSH_INTERVAL)
+    if HOT_REFRESH_BUDGET > 0:
+        updater.job_queue.run_repeating(hot_refresh_job, interval=HOT_REFRESH_INTERVAL, first=HOT_REFRESH_INTERVAL)
+    phase("updater")
+
+    allowed_updates = ["message", "callback_query", "inline_query", "chosen_inline_result"]
+    if MEMBERSHIP_UPDATES:
+        allowed_updates.append("chat_member")
+
+    stop_event = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda signum, frame: stop_event.set())
+
+    server = None
+    _accepting_updates.set()
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise RuntimeError("WEBHOOK_URL (or RENDER_EXTERNAL_URL) is required in webhook mode")
+        webhook_path = "/telegram/" + hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32]
+        server = start_http_server(dp, webhook_path)
+        threading.Thread(target=dp.start, name="dispatcher", daemon=True).start()
+        updater.job_queue.start()
+        updater.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + webhook_path,
+            allowed_updates=allowed_updates,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+        logger.info("Bot starting (webhook)...")
+    else:
+        if PORT:
+            server = start_http_server(dp)
+        logger.info("Bot starting (polling)...")
+        updater.start_polling(allowed_updates=allowed_updates)
+    phase("serving")
+    startup = sum(secs for _, secs in phases)
+    metrics.gauge_add("groupbot_startup_seconds", startup)
+    logger.info(
+        "Ready in %.2fs: %s",
+        startup,
+        " ".join(f"{name}={secs * 1000:.0f}ms" for name, secs in phases),
+    )
+
+    while not stop_event.wait(1):
+        pass
+    logger.info("Shutting down, draining in-flight requests...")
+    _accepting_updates.clear()
+    if BOT_MODE == "webhook":
+        wait_for_drain(DRAIN_TIMEOUT)
+        updater.job_queue.stop()
+        dp.stop()
+    else:
+        # stops polling first, then joins the dispatcher workers
+        updater.stop()
+        wait_for_drain(DRAIN_TIMEOUT)
+    if server:
+        server.shutdown()
+    connector.cancel()
+    stop_tele_loop()
+    stop_persist_writer()
+    flush_stats()
+    close_db()
+    if SNAPSHOT_PATH:
+        started = time.perf_counter()
+        try:
+            saved = save_snapshot()
+            logger.info("Saved %s cache entries to %s in %.0fms", saved, SNAPSHOT_PATH, (time.perf_counter() - started) * 1000)
+        except OSError as e:
+            logger.warning("Could not save snapshot: %s", e)
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "bulkcheck":
+        sys.exit(bulkcheck_cli(sys.argv[2:]))
     main()
\ No newline at end of file
@@ -9,4 +9,5 @@ API_HASH = os.getenv("API_HASH") or input("API_HASH: ")
 with TelegramClient(StringSession(), API_ID, API_HASH) as client:
     print("StringSession:\n")
     print(client.session.save())
-    print("\nCopy this string and set TELETHON_SESSION env var on Render.")
\ No newline at end of file
+    print("\nCopy this string and set TELETHON_SESSION env var on Render.")
+    print("To spread lookups over more accounts, add extra strings to TELETHON_SESSIONS (comma separated).")
\ No newline at end of file